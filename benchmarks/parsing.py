@@ -0,0 +1,98 @@
+"""
+Compare the lxml/XPath extraction of the backends with the previous BeautifulSoup extraction on the synthetic pages
+of benchmarks/fixtures (see fixtures/README.md for their limits). Checks that both produce the same output.
+Requires beautifulsoup4.
+
+python benchmarks/parsing.py [--repeat 20]
+"""
+import argparse
+import re
+import timeit
+from pathlib import Path
+
+from bs4 import BeautifulSoup, NavigableString
+
+from mercari import Mercari, Rakuma
+# noinspection PyProtectedMember
+from mercari.common import _parse_html
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+ITEM_URL = 'https://www.mercari.com/jp/items/m48210000000/'
+
+
+def soup_mercari_search(content):
+    soup = BeautifulSoup(content, 'lxml')
+    search_res_head_tag = soup.find('h2', {'class': 'search-result-head'})
+    items = [s.find('a').attrs['href'] for s in soup.find_all('section', {'class': 'items-box'})]
+    items = [it if it.startswith('http') else 'https://www.mercari.com' + it for it in items]
+    return items, re.findall(r'\d+', str(search_res_head_tag.contents[0]).strip())
+
+
+def soup_mercari_item(content):
+    soup = BeautifulSoup(content, 'lxml')
+    soup = soup.find('section', {'class': 'item-box-container'})
+    price = str(soup.find('span', {'class': 'item-price bold'}).contents[0]).replace('¥', '').replace(',', '')
+    name = str(soup.find('h1', {'class': 'item-name'}).contents[0])
+    desc = filter(lambda x: isinstance(x, NavigableString), soup.find('div', {'class': 'item-description f14'}))
+    desc = ''.join(map(str, desc))
+    sold_out = soup.find('div', {'class': 'item-sold-out-badge'}) is not None
+    photo = soup.find('div', {'class': 'item-photo'}).find('img').attrs['data-src']
+    return name, int(price), desc, sold_out, photo, ITEM_URL
+
+
+def soup_rakuma_search(content):
+    soup = BeautifulSoup(content, 'lxml')
+    return [item.a.attrs['href'] for item in soup.find_all('div', {'class': 'item-box__image-wrapper'})], None
+
+
+def soup_rakuma_item(content):
+    soup = BeautifulSoup(content, 'lxml')
+
+    def fetch_meta(n):
+        return soup.find('meta', {'property': n}).attrs['content']
+
+    name = fetch_meta('og:title')
+    if '|' in name:
+        name = name.split('|')[0]
+    return (name, int(fetch_meta('product:price:amount')), fetch_meta('og:description'),
+            'out' in fetch_meta('product:availability'), fetch_meta('og:image'), ITEM_URL)
+
+
+def lxml_search(backend):
+    def parse(content):
+        items, marker = backend._parse_items_page(_parse_html(content))
+        return items, None if marker is None else re.findall(r'\d+', marker.text.strip())
+
+    return parse
+
+
+def lxml_item(backend):
+    def parse(content):
+        item = backend._parse_item_page(_parse_html(content), ITEM_URL)
+        return item.name, item.price, item.desc, item.sold_out, item.url_photo, item.url
+
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML parsing benchmark.')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    mercari, rakuma = Mercari(), Rakuma()
+    cases = [
+        ('mercari_search.html', soup_mercari_search, lxml_search(mercari)),
+        ('mercari_item.html', soup_mercari_item, lxml_item(mercari)),
+        ('rakuma_search.html', soup_rakuma_search, lxml_search(rakuma)),
+        ('rakuma_item.html', soup_rakuma_item, lxml_item(rakuma)),
+    ]
+    print(f'{"page":<22}{"soup (ms)":>12}{"lxml (ms)":>12}{"speedup":>10}')
+    for fixture, soup_parse, lxml_parse in cases:
+        content = (FIXTURES / fixture).read_bytes()
+        assert soup_parse(content) == lxml_parse(content), f'Different outputs for {fixture}.'
+        soup_time = min(timeit.repeat(lambda: soup_parse(content), number=1, repeat=args.repeat)) * 1000
+        lxml_time = min(timeit.repeat(lambda: lxml_parse(content), number=1, repeat=args.repeat)) * 1000
+        print(f'{fixture:<22}{soup_time:>12.2f}{lxml_time:>12.2f}{soup_time / lxml_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Benchmark of the scraping hot paths without network: the synthetic pages and photo in benchmarks/fixtures are
+served by a local stand-in (see replay_server.py), in its own process.
+
+Scenarios:
+- search: fetch_all_items() over --pages search pages.
+- item: get_item_infos() on --items item pages.
+- photo: download_photos() of --items photos into an empty photo cache.
+- poll: --pages polls of the monitor: the newest search page (fetch_new_listings()), then the item pages of
+  --new_items new items and the download of their photos (the attachments of the notification).
+
+Each scenario runs in the sequential (1 worker), threaded (--workers threads) and async (--workers tasks, requires
+aiohttp) modes, each in a fresh process. Reports pages/sec, items/sec, p50/p99 latency of a page (or photo), peak
+memory and CPU time per item, as JSON so that the results can be compared across commits.
+
+python benchmarks/replay.py [--latency 0.02] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from typing import List, Callable
+
+from mercari import Mercari, Rakuma, Item, PhotoCache, RateLimiter, HighWaterMark, build_session, download_photos
+# noinspection PyProtectedMember
+from mercari.common import _parse_html
+
+import replay_server
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+KEYWORD = 'CHANEL'
+BACKENDS = {'mercari': Mercari, 'rakuma': Rakuma}
+SCENARIOS = ('search', 'item', 'photo', 'poll')
+MODES = ('sequential', 'threaded', 'async')
+# Reported metrics, with True if higher is better (see --compare).
+METRICS = {'pages_per_sec': True, 'items_per_sec': True, 'latency_p50_ms': False, 'latency_p99_ms': False,
+           'cpu_ms_per_item': False, 'peak_rss_mb': False}
+
+
+def _timed(f: Callable, latencies: List[float]) -> Callable:
+    @wraps(f)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return timed
+
+
+def _timed_async(f: Callable, latencies: List[float]) -> Callable:
+    @wraps(f)
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return timed
+
+
+def _percentile(values: List[float], p: float) -> float:
+    # nearest rank.
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def _max_rss_mb() -> float:
+    # kilobytes on Linux, bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _item_urls(backend_name: str, count: int) -> List[str]:
+    # the URLs of the search page, made unique with a query string if more are needed.
+    backend = BACKENDS[backend_name]
+    items, _ = backend()._parse_items_page(_parse_html((FIXTURES / f'{backend_name}_search.html').read_bytes()))
+    return [items[i % len(items)] + ('' if i < len(items) else f'?r={i}') for i in range(count)]
+
+
+def _photo_urls(backend_name: str, count: int) -> List[str]:
+    backend = BACKENDS[backend_name]
+    tree = _parse_html((FIXTURES / f'{backend_name}_item.html').read_bytes())
+    item = backend()._parse_item_page(tree, _item_urls(backend_name, 1)[0])
+    return [item.url_photo + ('&' if '?' in item.url_photo else '?') + f'r={i}' for i in range(count)]
+
+
+def _photo_items(backend_name: str, count: int, session, photo_cache: PhotoCache) -> List[Item]:
+    return [Item(name='photo', price=0, desc='', sold_out=False, url_photo=url_photo, url=url_photo,
+                 session=session, photo_cache=photo_cache, marketplace=backend_name)
+            for url_photo in _photo_urls(backend_name, count)]
+
+
+def _bust_photo_cache(items: List[Item], poll: int):
+    # the photos of each poll are new ones: a query string keeps them out of the photo cache.
+    for item in items:
+        item.url_photo += ('&' if '?' in item.url_photo else '?') + f'r={poll}'
+
+
+def _poll(backend, keyword: str, new_items: int, workers: int, poll: int) -> int:
+    # one poll of the monitor, everything new: newest search page, item pages, photos.
+    listings = backend.fetch_new_listings(keyword, HighWaterMark())
+    items = backend.get_item_infos([listing.url for listing in listings[:new_items]], max_workers=workers)
+    assert all(isinstance(item, Item) for item in items)
+    _bust_photo_cache(items, poll)
+    download_photos(items, workers)
+    return len(items)
+
+
+async def _poll_async(backend, keyword: str, new_items: int, workers: int, poll: int) -> int:
+    # see _poll().
+    listings = await backend.fetch_new_listings(keyword, HighWaterMark())
+    items = await backend.get_item_infos([listing.url for listing in listings[:new_items]], max_workers=workers)
+    assert all(isinstance(item, Item) for item in items)
+    _bust_photo_cache(items, poll)
+    await backend.download_photos(items, workers)
+    return len(items)
+
+
+def run_sync(backend_name: str, scenario: str, workers: int, options: dict, port: int, latencies: List[float]):
+    # returns the number of pages and items.
+    with tempfile.TemporaryDirectory() as directory:
+        photo_cache = PhotoCache(directory)
+        session = build_session(transport=replay_server.RewriteAdapter(port, pool_maxsize=workers))
+        backend = BACKENDS[backend_name](session=session, photo_cache=photo_cache,
+                                         rate_limiter=RateLimiter(rate=1e9, burst=10 ** 9))
+        if scenario == 'search':
+            page_size = len(backend.fetch_items_pagination(KEYWORD)[0])  # warm up.
+            backend.fetch_items_pagination = _timed(backend.fetch_items_pagination, latencies)
+            items = backend.fetch_all_items(KEYWORD, max_items_to_fetch=options['pages'] * page_size, prefetch=workers)
+            return len(latencies), len(items)
+        if scenario == 'item':
+            backend.get_item_info(_item_urls(backend_name, 1)[0])  # warm up.
+            backend.get_item_info = _timed(backend.get_item_info, latencies)
+            items = backend.get_item_infos(_item_urls(backend_name, options['items']), max_workers=workers)
+            assert all(isinstance(item, Item) for item in items)
+            return len(items), len(items)
+        if scenario == 'poll':
+            _poll(backend, KEYWORD, options['new_items'], workers, -1)  # warm up.
+            poll = _timed(_poll, latencies)
+            items = sum(poll(backend, KEYWORD, options['new_items'], workers, i) for i in range(options['pages']))
+            return options['pages'], items
+        photo_cache.fetch = _timed(photo_cache.fetch, latencies)
+        photos = download_photos(_photo_items(backend_name, options['items'], session, photo_cache), workers)
+        return 0, len(photos)
+
+
+async def run_async(backend_name: str, scenario: str, workers: int, options: dict, port: int,
+                    latencies: List[float]):
+    # see run_sync().
+    from mercari.aio import AsyncMercari, AsyncRakuma, build_async_session
+
+    with tempfile.TemporaryDirectory() as directory:
+        photo_cache = PhotoCache(directory)
+        session = replay_server.RewriteSession(build_async_session(limit_per_host=workers), port)
+        backend_cls = {'mercari': AsyncMercari, 'rakuma': AsyncRakuma}[backend_name]
+        backend = backend_cls(session=session, photo_cache=photo_cache,
+                              rate_limiter=RateLimiter(rate=1e9, burst=10 ** 9))
+        try:
+            if scenario == 'search':
+                page_size = len((await backend.fetch_items_pagination(KEYWORD))[0])
+                backend.fetch_items_pagination = _timed_async(backend.fetch_items_pagination, latencies)
+                items = await backend.fetch_all_items(KEYWORD, max_items_to_fetch=options['pages'] * page_size,
+                                                      prefetch=workers)
+                return len(latencies), len(items)
+            if scenario == 'item':
+                await backend.get_item_info(_item_urls(backend_name, 1)[0])
+                backend.get_item_info = _timed_async(backend.get_item_info, latencies)
+                items = await backend.get_item_infos(_item_urls(backend_name, options['items']), max_workers=workers)
+                assert all(isinstance(item, Item) for item in items)
+                return len(items), len(items)
+            if scenario == 'poll':
+                await _poll_async(backend, KEYWORD, options['new_items'], workers, -1)
+                poll = _timed_async(_poll_async, latencies)
+                items = 0
+                for i in range(options['pages']):
+                    items += await poll(backend, KEYWORD, options['new_items'], workers, i)
+                return options['pages'], items
+            backend._download_photo = _timed_async(backend._download_photo, latencies)
+            photos = await backend.download_photos(_photo_items(backend_name, options['items'], None, photo_cache),
+                                                   workers)
+            return 0, len(photos)
+        finally:
+            await session.close()
+
+
+def run_case(backend_name: str, scenario: str, mode: str, options: dict, port: int,
+             results: multiprocessing.Queue):
+    # runs in a fresh process: the peak memory and the CPU time are the ones of this case only.
+    workers = 1 if mode == 'sequential' else options['workers']
+    latencies = []
+    rss_before = _max_rss_mb()
+    cpu_start, start = time.process_time(), time.perf_counter()
+    if mode == 'async':
+        pages, items = asyncio.run(run_async(backend_name, scenario, workers, options, port, latencies))
+    else:
+        pages, items = run_sync(backend_name, scenario, workers, options, port, latencies)
+    duration, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    results.put({
+        'backend': backend_name,
+        'scenario': scenario,
+        'mode': mode,
+        'workers': workers,
+        'pages': pages,
+        'items': items,
+        'duration_s': round(duration, 4),
+        'pages_per_sec': round(pages / duration, 2),
+        'items_per_sec': round(items / duration, 2),
+        'latency_p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'latency_p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+        'cpu_ms_per_item': round(cpu * 1000 / max(items, 1), 3),
+        'peak_rss_mb': round(_max_rss_mb(), 1),
+        'rss_growth_mb': round(_max_rss_mb() - rss_before, 1)
+    })
+
+
+def _wait_result(process: multiprocessing.Process, results: multiprocessing.Queue, timeout: float):
+    # None if the case process died (or timed out) before reporting its result.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if process.exitcode is not None:
+                # the result may have been put just before the exit.
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return None
+    process.terminate()
+    return None
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(results: List[dict], baseline: dict):
+    # relative change of each metric against a previous run, positive is better.
+    previous = {(r['backend'], r['scenario'], r['mode']): r for r in baseline['results']}
+    print(f'\nCompared to {baseline["meta"]["commit"] or "baseline"}:', file=sys.stderr)
+    print(f'{"case":<28}' + ''.join(f'{m:>16}' for m in METRICS), file=sys.stderr)
+    for result in results:
+        before = previous.get((result['backend'], result['scenario'], result['mode']))
+        if before is None:
+            continue
+        changes = []
+        for metric, higher_is_better in METRICS.items():
+            if before[metric] == 0:
+                changes.append(f'{"-":>16}')
+                continue
+            change = (result[metric] - before[metric]) / before[metric] * 100
+            changes.append(f'{change if higher_is_better else -change:>+15.1f}%')
+        print(f'{result["backend"] + "/" + result["scenario"] + "/" + result["mode"]:<28}' + ''.join(changes),
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the scraping hot paths.')
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--pages', type=int, default=20, help='Number of search pages to fetch (or of polls).')
+    parser.add_argument('--items', type=int, default=100, help='Number of item pages (or photos) to fetch.')
+    parser.add_argument('--new_items', type=int, default=5, help='Number of new items per poll.')
+    parser.add_argument('--timeout', type=float, default=600, help='Maximum number of seconds per case.')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrency of the threaded and async modes.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Delay added by the stand-in to each response, in seconds.')
+    parser.add_argument('--output', type=str, help='Where to write the JSON results (default: stdout).')
+    parser.add_argument('--compare', type=str, help='JSON results of a previous run to compare with.')
+    args = parser.parse_args()
+    options = {'pages': args.pages, 'items': args.items, 'new_items': args.new_items, 'workers': args.workers,
+               'latency': args.latency}
+
+    server, port = replay_server.start(args.latency)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        print(f'{"case":<28}{"pages/s":>10}{"items/s":>10}{"p50 (ms)":>10}{"p99 (ms)":>10}'
+              f'{"cpu/item (ms)":>15}{"rss (MB)":>10}', file=sys.stderr)
+        for backend_name in args.backends:
+            for scenario in args.scenarios:
+                for mode in args.modes:
+                    case_results = context.Queue()
+                    process = context.Process(target=run_case,
+                                              args=(backend_name, scenario, mode, options, port, case_results))
+                    process.start()
+                    result = _wait_result(process, case_results, args.timeout)
+                    process.join()
+                    if result is None:
+                        print(f'{backend_name + "/" + scenario + "/" + mode:<28}failed (exit code: '
+                              f'{process.exitcode}).', file=sys.stderr)
+                        continue
+                    results.append(result)
+                    print(f'{backend_name + "/" + scenario + "/" + mode:<28}{result["pages_per_sec"]:>10.1f}'
+                          f'{result["items_per_sec"]:>10.1f}{result["latency_p50_ms"]:>10.2f}'
+                          f'{result["latency_p99_ms"]:>10.2f}{result["cpu_ms_per_item"]:>15.3f}'
+                          f'{result["peak_rss_mb"]:>10.1f}', file=sys.stderr)
+    finally:
+        server.terminate()
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': options
+        },
+        'results': results
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare is not None:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == '__main__':
+    main()
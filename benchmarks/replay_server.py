@@ -0,0 +1,121 @@
+"""
+Local HTTP stand-in for Mercari and Rakuma, serving the synthetic pages in benchmarks/fixtures.
+
+The requests are rewritten from https://<host>/<path> to http://127.0.0.1:<port>/<host>/<path> by
+RewriteAdapter (requests) and RewriteSession (aiohttp). Any search page returns the search page of the fixtures,
+any item page their item page and any photo their photo.
+"""
+import multiprocessing
+import socket
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse
+
+from requests.adapters import HTTPAdapter
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+# (host, path prefix, fixture, content type)
+ROUTES = [
+    ('www.mercari.com', '/jp/search', 'mercari_search.html', 'text/html; charset=utf-8'),
+    ('www.mercari.com', '/jp/items/', 'mercari_item.html', 'text/html; charset=utf-8'),
+    ('fril.jp', '/s', 'rakuma_search.html', 'text/html; charset=utf-8'),
+    ('item.fril.jp', '/', 'rakuma_item.html', 'text/html; charset=utf-8'),
+    ('static.mercdn.net', '/', 'photo.jpg', 'image/jpeg'),
+    ('img.fril.jp', '/', 'photo.jpg', 'image/jpeg'),
+]
+
+
+def rewrite(url: str, port: int) -> str:
+    u = urlparse(url)
+    return urlunparse(('http', f'127.0.0.1:{port}', '/' + u.netloc + u.path, '', u.query, ''))
+
+
+class RewriteAdapter(HTTPAdapter):
+
+    def __init__(self, port: int, **kwargs):
+        self.port = port
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = rewrite(request.url, self.port)
+        return super().send(request, **kwargs)
+
+
+class RewriteSession:
+
+    def __init__(self, session, port: int):
+        # aiohttp.ClientSession with the URLs rewritten to the stand-in. Only get() is used by the async backends.
+        self.session = session
+        self.port = port
+
+    def get(self, url: str, **kwargs):
+        return self.session.get(rewrite(url, self.port), **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+def _handler(fixtures, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive.
+
+        def setup(self):
+            super().setup()
+            # no delayed ACK between the headers and the body.
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            u = urlparse(self.path)
+            host, _, path = u.path.lstrip('/').partition('/')
+            path = '/' + path
+            for route_host, prefix, fixture, content_type in ROUTES:
+                if host == route_host and path.startswith(prefix):
+                    body = fixtures[fixture]
+                    break
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if latency > 0:
+                time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the benchmarks close the connections of the cancelled requests.
+        pass
+
+
+def serve(port_queue: multiprocessing.Queue, latency: float):
+    fixtures = {route[2]: (FIXTURES / route[2]).read_bytes() for route in ROUTES}
+    server = ReplayServer(('127.0.0.1', 0), _handler(fixtures, latency))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(latency: float = 0.0):
+    """
+    Start the stand-in in its own process, so that its CPU time is not counted in the benchmarks.
+    :param latency: Delay added to each response, in seconds.
+    :rtype: The process and the port of the server.
+    """
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    process = context.Process(target=serve, args=(port_queue, latency), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
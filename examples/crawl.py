@@ -0,0 +1,67 @@
+import argparse
+import logging
+
+from mercari import bulk_crawl, work_units, split_prices, RateLimiter
+from mercari.crawl import BACKENDS
+
+logger = logging.getLogger(__name__)
+
+
+def get_script_arguments():
+    parser = argparse.ArgumentParser(description='Snapshot of all the items matching many keywords, '
+                                                 'crawled by a pool of processes.')
+    parser.add_argument('--keywords', required=True, type=str, help='Keywords separated by a comma.')
+    parser.add_argument('--output', default='snapshot.jsonl', type=str, help='Where to write the items (JSONL).')
+    parser.add_argument('--marketplaces', default='mercari,rakuma', type=str,
+                        help='Marketplaces separated by a comma.')
+    parser.add_argument('--min_price', type=int, help='Minimum price of the items.')
+    parser.add_argument('--max_price', type=int, help='Maximum price of the items.')
+    parser.add_argument('--price_bands', default=1, type=int,
+                        help='Number of price bands each keyword is split into (requires --min_price and --max_price).')
+    parser.add_argument('--adaptive_bands', action='store_true',
+                        help='Split each keyword into price bands small enough to be crawled completely.')
+    parser.add_argument('--processes', type=int, help='Number of processes. Defaults to the number of CPUs.')
+    parser.add_argument('--threads', default=4, type=int, help='Item pages fetched at the same time by each process.')
+    parser.add_argument('--requests_per_second', default=1.0, type=float,
+                        help='Maximum number of requests per second to each website, for all the processes.')
+    parser.add_argument('--max_items_per_unit', type=int,
+                        help='Maximum number of items per keyword, marketplace and price band.')
+    args = parser.parse_args()
+    logger.info(args)
+    return args
+
+
+def adaptive_work_units(keywords, marketplaces, price_min, price_max, requests_per_second):
+    # the bands of each keyword depend on how its items are spread over the prices.
+    units = []
+    for marketplace in marketplaces:
+        backend = BACKENDS[marketplace](rate_limiter=RateLimiter(requests_per_second, burst=2))
+        for keyword in keywords:
+            price_bands = backend.price_bands(keyword, price_min, price_max)
+            logger.info(f'[{keyword}] {len(price_bands)} price bands on {marketplace}.')
+            units.extend(work_units([keyword], [marketplace], price_bands))
+    return units
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    args = get_script_arguments()
+    keywords = [keyword.strip() for keyword in args.keywords.strip().split(',')]
+    marketplaces = args.marketplaces.strip().split(',')
+    if args.adaptive_bands:
+        units = adaptive_work_units(keywords, marketplaces, args.min_price, args.max_price, args.requests_per_second)
+    else:
+        if args.price_bands > 1:
+            assert args.min_price is not None and args.max_price is not None
+            price_bands = split_prices(args.min_price, args.max_price, args.price_bands)
+        else:
+            price_bands = [(args.min_price, args.max_price)]
+        units = work_units(keywords, marketplaces, price_bands)
+    logger.info(f'{len(units)} work units.')
+    stats = bulk_crawl(units, args.output, processes=args.processes, threads=args.threads,
+                       rate=args.requests_per_second, burst=2, max_items_per_unit=args.max_items_per_unit)
+    logger.info(f'{stats["items"]} items written to [{args.output}] in {stats["duration"]:.1f} seconds: {stats}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,25 @@
 import argparse
 import json
 import logging
-import os
 import threading
+from functools import partial
 from time import sleep
-from typing import Union
-
-import requests
-from mailthon import postman, email
+from typing import List, Union, TYPE_CHECKING
 
+from mercari import HighWaterMark
+from mercari import Item, Listing
 from mercari import Mercari
+from mercari import Metrics, serve_metrics
+from mercari import PhotoCache
 from mercari import Rakuma
+from mercari import RateLimiter
+from mercari import SeenStore
+from mercari import PollScheduler
+from mercari.common import Common
+from notifications import Alertzy, GMailSender, NotificationDispatcher
+
+if TYPE_CHECKING:
+    from mercari.photo_index import PhotoIndex
 
 logger = logging.getLogger(__name__)
 
@@ -25,159 +34,182 @@ def get_script_arguments():
                         help='Minimum price for each item separated by a comma.')
     parser.add_argument('--disable_alertzy', action='store_true')
     parser.add_argument('--disable_gmail', action='store_true')
+    parser.add_argument('--seen_items_db', default='seen_items.db', type=str,
+                        help='Where to persist the items already seen (survives restarts).')
+    parser.add_argument('--seen_items_max_age_days', default=30, type=float,
+                        help='Number of days after which a seen item is forgotten.')
+    parser.add_argument('--requests_per_second', default=1.0, type=float,
+                        help='Maximum number of requests per second to each website, for all the keywords.')
+    parser.add_argument('--max_workers', default=4, type=int, help='Number of keywords polled at the same time.')
+    parser.add_argument('--min_interval', default=30, type=float,
+                        help='Minimum number of seconds between two polls of the same keyword.')
+    parser.add_argument('--max_interval', default=600, type=float,
+                        help='Maximum number of seconds between two polls of the same keyword '
+                             '(reached when no new items are found).')
+    parser.add_argument('--digest_window', default=5, type=float,
+                        help='New items found within this number of seconds are sent in a single notification.')
+    parser.add_argument('--duplicate_photo_distance', default=4, type=int,
+                        help='New items whose photo is within this Hamming distance of the photo of an item already '
+                             'seen (on any website) are skipped. -1 to disable. Requires numpy and Pillow (disabled '
+                             'otherwise). The photos are indexed in memory only: the index restarts empty, from the '
+                             'outstanding items of the first polls.')
+    parser.add_argument('--metrics_interval', default=600, type=float,
+                        help='Number of seconds between two logs of the metrics.')
+    parser.add_argument('--metrics_port', type=int,
+                        help='Serve the metrics in the Prometheus format on http://localhost:<port>/metrics.')
     args = parser.parse_args()
     logger.info(args)
     return args
 
 
-class Alertzy:
-
-    def __init__(self):
-        self.use_module = True
-        self.lock = threading.Lock()
-        config_filename = 'alertzy_conf.json'
-        if os.path.isfile(config_filename):
-            with open(config_filename, 'r') as r:
-                self.alertzy_key = json.load(r)['alertzy_key']
-            self.send_notification('Monitoring has started.', title='Mercari')
-        else:
-            self.use_module = False
-            logger.warning('Alertzy was not configured. Notifications will not be sent to your '
-                           'iPhone through the Alertzy app.')
-
-    def send_notification(self, message, title):
-        # https://alertzy.app/
-        if self.use_module:
-            with self.lock:
-                assert self.alertzy_key is not None
-                try:
-                    requests.post('https://alertzy.app/send', data={
-                        'accountKey': self.alertzy_key,
-                        'title': title,
-                        'message': message
-                    })
-                except Exception:
-                    return False
-                return True
-
-
-class GMailSender:
-    def __init__(self):
-        self.use_module = True
-        self.lock = threading.Lock()
-        gmail_config_filename = 'gmail_conf.json'
-        if os.path.isfile(gmail_config_filename):
-            with open(gmail_config_filename, 'r') as gmail:
-                gmail_constants = json.load(gmail)
-                self.gmail_password = gmail_constants['gmail_password']
-                self.gmail_user = gmail_constants['gmail_user']
-                if '@' not in self.gmail_user:
-                    logger.error('Gmail user should be a GMAIL address.')
-                    exit(1)
-                self.recipients = [x.strip() for x in gmail_constants['recipients'].strip().split(',')]
-            self.send_email_notification('Mercari', 'Monitoring has started.')
-        else:
-            self.use_module = False
-            logger.warning('Gmail is not configured. If you want to receive email notifications, '
-                           'copy gmail_conf.json.example to gmail_conf.json and edit the constants. '
-                           'I advise you to create a new Gmail account, just for this purpose.')
-
-    def send_email_notification(self, email_subject, email_content, attachment=None):
-        if self.use_module:
-            with self.lock:
-                if attachment is not None:
-                    attachment = [attachment]
-                else:
-                    attachment = ()
-                for recipient in self.recipients:
-                    p = postman(host='smtp.gmail.com', auth=(self.gmail_user, self.gmail_password))
-                    r = p.send(email(content=email_content,
-                                     subject=email_subject,
-                                     sender='{0} <{0}>'.format(self.gmail_user),
-                                     receivers=[recipient],
-                                     attachments=attachment))
-                    logger.info(f'Email subject is {email_subject}.')
-                    logger.info(f'Email content is {email_content}.')
-                    logger.info(f'Attachment located at {attachment}.')
-                    logger.info(f'Notification sent from {self.gmail_user} to {recipient}.')
-                    assert r.ok
-
-
 class MonitorKeyword:
     def __init__(self, keyword: str, price_min: int, price_max: int,
-                 gmail_sender: Union[None, GMailSender],
-                 alertzy: Union[None, Alertzy]):
+                 dispatcher: NotificationDispatcher):
         self.keyword = keyword
         self.price_min = price_min
         self.price_max = price_max
-        self.gmail_sender = gmail_sender
-        self.alertzy = alertzy
-        self.thread = threading.Thread(target=self._run, daemon=True)
-        self.mercari = Mercari()
-        self.rakuma = Rakuma()
-        self.persisted_items = []
-
-    def join(self):
-        self.thread.join()
-
-    def start_monitoring(self):
-        self.thread.start()
-
-    def scrape_outstanding_items(self):
-        for backend in [self.mercari, self.rakuma]:
-            items = backend.fetch_all_items(
-                keyword=self.keyword,
-                price_min=self.price_min,
-                price_max=self.price_max,
-                max_items_to_fetch=100
-            )
-            self.persisted_items.extend(items)
-            logger.info(f'{len(items)} items found for {backend.name}.')
-        logger.info(f'{len(self.persisted_items)} items found in total.')
-
-    def check_for_new_items(self):
-        for backend in [self.mercari, self.rakuma]:
-            items_on_first_page, _ = backend.fetch_items_pagination(
-                keyword=self.keyword,
-                price_min=self.price_min,
-                price_max=self.price_max
-            )
-            new_items = set(items_on_first_page) - set(self.persisted_items)
-            for new_item in new_items:
-                logger.info(f'[{self.keyword}] New item detected: {new_item}.')
-                self.persisted_items.append(new_item)
-                item = backend.get_item_info(new_item)
-                email_subject = f'{item.name} {item.price}'
-                email_subject_with_url = f'{email_subject} {item.url}'
-                email_content = f'{item.url}<br/><br/>{item.desc}'
-                attachment = item.local_url
-                if self.alertzy is not None:
-                    logger.info('Will send an Alertzy notification.')
-                    self.alertzy.send_notification(email_subject_with_url, title=self.keyword)
-                else:
-                    logger.info('Will skip Alertzy.')
-                if self.gmail_sender is not None:
-                    logger.info('Will send a GMAIL notification.')
-                    self.gmail_sender.send_email_notification(email_subject, email_content, attachment)
-                else:
-                    logger.info('Will skip GMAIL.')
-
-    # noinspection PyBroadException
-    def _run(self):
-        logger.info(f'[{self.keyword}] Starting monitoring with price_max: {self.price_max} '
-                    f'and price_min: {self.price_min}.')
-        self.scrape_outstanding_items()
-        time_between_two_requests = 30
-        logger.info(f'We will check the first page(s) every {time_between_two_requests} seconds '
-                    f'and look for new items.')
-        logger.info('The program has started to monitor for new items...')
-        while True:
-            sleep(time_between_two_requests)
+        self.dispatcher = dispatcher
+
+    def accepts(self, item: Union[Item, Listing]) -> bool:
+        return self.price_min <= item.price <= self.price_max
+
+    def notify(self, item: Item):
+        # the notifications are sent in the background.
+        self.dispatcher.submit(self.keyword, item)
+
+
+class MonitorQuery:
+    def __init__(self, keyword: str,
+                 subscribers: List[MonitorKeyword],
+                 seen_items: SeenStore,
+                 backends: List[Common],
+                 photo_index: Union[None, 'PhotoIndex'] = None):
+        # one upstream query for all the subscribers: same keyword and union of their price ranges.
+        self.keyword = keyword
+        self.subscribers = subscribers
+        self.price_min = min(s.price_min for s in subscribers)
+        self.price_max = max(s.price_max for s in subscribers)
+        # shared by all the keywords.
+        self.seen_items = seen_items
+        self.backends = backends
+        self.photo_index = photo_index
+        self.scraped_backends = set()
+        # newest items seen on each backend: a poll only fetches the pages listed since the previous one.
+        self.high_water_marks = {backend.name: HighWaterMark() for backend in backends}
+
+    def poll(self, backend: Common) -> int:
+        # the first poll marks the outstanding items as seen. The next ones look for new items.
+        if backend.name not in self.scraped_backends:
+            logger.info(f'[{self.keyword}] Starting monitoring on {backend.name} with price_max: {self.price_max} '
+                        f'and price_min: {self.price_min} ({len(self.subscribers)} subscribers).')
+            self.scrape_outstanding_items_on(backend)
+            self.scraped_backends.add(backend.name)
+            return 0
+        return self.check_for_new_items_on(backend)
+
+    def scrape_outstanding_items_on(self, backend: Common):
+        listings = list(backend.iter_listings(
+            keyword=self.keyword,
+            price_min=self.price_min,
+            price_max=self.price_max,
+            max_items_to_fetch=100
+        ))
+        # the newest items are not necessarily the most relevant ones.
+        listings += backend.fetch_new_listings(
+            keyword=self.keyword,
+            high_water_mark=self.high_water_marks[backend.name],
+            price_min=self.price_min,
+            price_max=self.price_max
+        )
+        self.seen_items.add_many(backend.name, [listing.item_id for listing in listings])
+        if self.photo_index is not None:
+            # the relisted outstanding items are duplicates too.
+            for listing in listings:
+                self.is_duplicate_photo(backend, listing)
+        logger.info(f'{len(listings)} items found for {backend.name}.')
+
+    def check_for_new_items_on(self, backend: Common) -> int:
+        high_water_mark = self.high_water_marks[backend.name]
+        previous_item_ids = list(high_water_mark.item_ids)
+        # the summaries of the search pages are enough to discard most of the items without fetching their pages.
+        listings = backend.fetch_new_listings(
+            keyword=self.keyword,
+            high_water_mark=high_water_mark,
+            price_min=self.price_min,
+            price_max=self.price_max
+        )
+        # the seen items also cover the restarts and the items put back on sale.
+        listing_ids = {listing.item_id: listing for listing in listings}
+        new_listings = [listing_ids[item_id] for item_id in self.seen_items.add_many(backend.name, list(listing_ids))]
+        failed_item_ids = []
+        for listing in new_listings:
+            logger.info(f'[{self.keyword}] New item detected: {listing}.')
             try:
-                self.check_for_new_items()
-            except Exception:
-                logger.exception('exception')
-                sleep(30)
+                self.process_new_listing(backend, listing)
+            except Exception as e:
+                logger.warning(f'[{self.keyword}] Could not process {listing.url}: {e!r}.')
+                failed_item_ids.append(listing.item_id)
+        if len(failed_item_ids) > 0:
+            # found again by the next poll, which starts from the same items as this one.
+            self.seen_items.discard(backend.name, failed_item_ids)
+            high_water_mark.item_ids = previous_item_ids
+        return len(new_listings)
+
+    def process_new_listing(self, backend: Common, listing: Listing):
+        subscribers = [subscriber for subscriber in self.subscribers if subscriber.accepts(listing)]
+        if len(subscribers) == 0 or self.is_duplicate_photo(backend, listing):
+            return
+        # fetched once, and dispatched to the subscribers by price.
+        item = backend.get_item_info(listing.url)
+        for subscriber in subscribers:
+            if subscriber.accepts(item):
+                subscriber.notify(item)
+
+    def is_duplicate_photo(self, backend: Common, listing: Listing) -> bool:
+        # the same goods listed on both websites, or relisted under a new URL. Only the thumbnail is downloaded,
+        # paced by the rate limiter of the backend (one bucket per photo host).
+        if self.photo_index is None or listing.url_thumbnail is None:
+            return False
+        from mercari.photo_index import hash_photo
+        try:
+            local_url = backend.photo_cache.fetch(listing.url_thumbnail, backend.session, backend.rate_limiter)
+            photo_hash = hash_photo(local_url)
+        except Exception as e:
+            logger.warning(f'Could not hash the photo of {listing.url}: {e!r}.')
+            return False
+        match = self.photo_index.seen(f'{backend.name}:{listing.item_id}', photo_hash)
+        if match is not None:
+            logger.info(f'[{self.keyword}] Same photo as {match}, skipped: {listing}.')
+        return match is not None
+
+
+def coalesce_queries(monitors: List[MonitorKeyword],
+                     seen_items: SeenStore,
+                     backends: List[Common],
+                     photo_index: Union[None, 'PhotoIndex'] = None) -> List[MonitorQuery]:
+    # merges the monitors with the same keyword and overlapping price ranges.
+    queries = []
+    by_keyword = {}
+    for monitor in monitors:
+        by_keyword.setdefault(monitor.keyword, []).append(monitor)
+    for keyword, keyword_monitors in by_keyword.items():
+        groups = []
+        for monitor in sorted(keyword_monitors, key=lambda m: m.price_min):
+            if groups and monitor.price_min <= max(m.price_max for m in groups[-1]):
+                groups[-1].append(monitor)
+            else:
+                groups.append([monitor])
+        queries.extend(MonitorQuery(keyword, group, seen_items, backends, photo_index) for group in groups)
+    logger.info(f'{len(monitors)} keywords coalesced into {len(queries)} queries.')
+    return queries
+
+
+def log_metrics(dispatcher: NotificationDispatcher, metrics: Metrics, interval: float):
+    # network (ttfb/download_seconds), parsing (parse_seconds) and notifications (notification_send_seconds).
+    while True:
+        sleep(interval)
+        logger.info(f'Notifications: {dispatcher.stats()}.')
+        logger.info(f'Metrics: {json.dumps(metrics.stats())}.')
 
 
 def init_logging():
@@ -205,15 +237,41 @@ def main():
     assert all([m1 < m2 for m1, m2 in zip(min_prices, max_prices)])
     gmail = None if args.disable_gmail else GMailSender()
     alertzy = None if args.disable_alertzy else Alertzy()
+    metrics = Metrics()
+    if args.metrics_port is not None:
+        serve_metrics(metrics, args.metrics_port)
+    dispatcher = NotificationDispatcher(gmail, alertzy, digest_window=args.digest_window, metrics=metrics)
+    dispatcher.start()
+    seen_items = SeenStore(args.seen_items_db, max_age=args.seen_items_max_age_days * 24 * 3600)
+    seen_items.expire()
+    # the rate limiter is shared by all the keywords: it is a global request budget per website (see
+    # MARKETPLACE_HOSTS: the two hosts of Rakuma share one budget).
+    rate_limiter = RateLimiter(rate=args.requests_per_second, burst=2)
+    photo_cache = PhotoCache(metrics=metrics)
+    backends = [Mercari(rate_limiter=rate_limiter, photo_cache=photo_cache, metrics=metrics),
+                Rakuma(rate_limiter=rate_limiter, photo_cache=photo_cache, metrics=metrics)]
     monitors = []
     for keyword, min_price, max_price in zip(keywords, min_prices, max_prices):
-        monitors.append(MonitorKeyword(keyword.strip(), min_price, max_price, gmail, alertzy))
-    for monitor in monitors:
-        monitor.start_monitoring()
-        sleep(5)  # delay the start between them.
-    # wait forever.
-    for monitor in monitors:
-        monitor.join()
+        monitors.append(MonitorKeyword(keyword.strip(), min_price, max_price, dispatcher))
+    photo_index = None
+    if args.duplicate_photo_distance >= 0:
+        try:
+            # optional dependencies: numpy and Pillow.
+            from mercari.photo_index import PhotoIndex
+        except ImportError as e:
+            logger.warning(f'Duplicate photos are not detected ({e}). Install mercari_python[photos] to enable it.')
+        else:
+            # shared by all the queries: detects the duplicates across keywords and websites.
+            photo_index = PhotoIndex(max_distance=args.duplicate_photo_distance)
+    queries = coalesce_queries(monitors, seen_items, backends, photo_index)
+    scheduler = PollScheduler(max_workers=args.max_workers, min_interval=args.min_interval,
+                              max_interval=args.max_interval, metrics=metrics)
+    scheduler.add_spread([(f'{query.keyword}/{query.price_min}-{query.price_max}/{backend.name}',
+                           partial(query.poll, backend))
+                          for query in queries for backend in backends], interval=args.min_interval)
+    threading.Thread(target=log_metrics, args=(dispatcher, metrics, args.metrics_interval), daemon=True).start()
+    logger.info('The program has started to monitor for new items...')
+    scheduler.run_forever()
 
 
 if __name__ == '__main__':
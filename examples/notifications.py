@@ -0,0 +1,324 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union, List, Tuple
+
+import requests
+from mailthon import email
+from mailthon.middleware import TLS, Auth
+from mailthon.postman import Postman
+
+from mercari import Item, Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Alertzy:
+
+    def __init__(self):
+        self.use_module = True
+        self.lock = threading.Lock()
+        # persistent HTTP connection.
+        self.session = requests.Session()
+        config_filename = 'alertzy_conf.json'
+        if os.path.isfile(config_filename):
+            with open(config_filename, 'r') as r:
+                self.alertzy_key = json.load(r)['alertzy_key']
+            self.send_notification('Monitoring has started.', title='Mercari')
+        else:
+            self.use_module = False
+            logger.warning('Alertzy was not configured. Notifications will not be sent to your '
+                           'iPhone through the Alertzy app.')
+
+    def send_notification(self, message, title):
+        # https://alertzy.app/
+        if self.use_module:
+            with self.lock:
+                assert self.alertzy_key is not None
+                try:
+                    response = self.session.post('https://alertzy.app/send', data={
+                        'accountKey': self.alertzy_key,
+                        'title': title,
+                        'message': message
+                    }, timeout=20)
+                except Exception:
+                    return False
+                return response.ok
+
+
+class GMailSender:
+    def __init__(self):
+        self.use_module = True
+        self.lock = threading.Lock()
+        self._conn_context = None
+        self._conn = None
+        gmail_config_filename = 'gmail_conf.json'
+        if os.path.isfile(gmail_config_filename):
+            with open(gmail_config_filename, 'r') as gmail:
+                gmail_constants = json.load(gmail)
+                self.gmail_password = gmail_constants['gmail_password']
+                self.gmail_user = gmail_constants['gmail_user']
+                if '@' not in self.gmail_user:
+                    logger.error('Gmail user should be a GMAIL address.')
+                    exit(1)
+                self.recipients = [x.strip() for x in gmail_constants['recipients'].strip().split(',')]
+                # optional: another SMTP server (e.g. a local one for testing). No login if the password is empty.
+                self.postman = _postman(
+                    host=gmail_constants.get('smtp_host', 'smtp.gmail.com'),
+                    port=gmail_constants.get('smtp_port', 587),
+                    auth=(self.gmail_user, self.gmail_password) if self.gmail_password else None
+                )
+            self.send_email_notification('Mercari', 'Monitoring has started.')
+        else:
+            self.use_module = False
+            logger.warning('Gmail is not configured. If you want to receive email notifications, '
+                           'copy gmail_conf.json.example to gmail_conf.json and edit the constants. '
+                           'I advise you to create a new Gmail account, just for this purpose.')
+
+    def send_email_notification(self, email_subject, email_content, attachment=None):
+        if self.use_module:
+            if attachment is None:
+                attachment = ()
+            elif isinstance(attachment, str):
+                attachment = [attachment]
+            with self.lock, self._connection() as conn:
+                for recipient in self.recipients:
+                    r = self.postman.deliver(conn, email(content=email_content,
+                                                         subject=email_subject,
+                                                         sender='{0} <{0}>'.format(self.gmail_user),
+                                                         receivers=[recipient],
+                                                         attachments=attachment))
+                    logger.info(f'Email subject is {email_subject}.')
+                    logger.info(f'Email content is {email_content}.')
+                    logger.info(f'Attachment located at {attachment}.')
+                    logger.info(f'Notification sent from {self.gmail_user} to {recipient}.')
+                    assert r.ok
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    @contextmanager
+    def _connection(self):
+        # the SMTP connection is kept open between two emails. It is re-opened if the server closed it.
+        if self._conn is not None:
+            try:
+                self._conn.noop()
+            except Exception:
+                self._close()
+        if self._conn is None:
+            self._conn_context = self.postman.connection()
+            self._conn = self._conn_context.__enter__()
+        try:
+            yield self._conn
+        except Exception:
+            self._close()
+            raise
+
+    def _close(self):
+        if self._conn_context is not None:
+            try:
+                self._conn_context.__exit__(None, None, None)
+            except Exception:
+                pass
+        self._conn_context = None
+        self._conn = None
+
+
+def _attachments(items: List[Item]) -> List[str]:
+    # the photos that cannot be downloaded are not attached.
+    attachments = []
+    for item in items:
+        try:
+            attachments.append(item.local_url)
+        except Exception as e:
+            logger.warning(f'Could not download the photo of {item.url}: {e!r}. It will not be attached.')
+    return attachments
+
+
+def _enabled(channel: Union[None, GMailSender, Alertzy]) -> bool:
+    # the channels without configuration file do not send anything.
+    return channel is not None and getattr(channel, 'use_module', True)
+
+
+def _postman(host: str, port: int, auth: Union[None, Tuple[str, str]]) -> Postman:
+    middlewares = [TLS(force=False)]
+    if auth is not None:
+        middlewares.append(Auth(*auth))
+    return Postman(host=host, port=port, middlewares=middlewares)
+
+
+class NotificationDispatcher:
+
+    def __init__(self,
+                 gmail_sender: Union[None, GMailSender],
+                 alertzy: Union[None, Alertzy],
+                 digest_window: float = 5,
+                 max_queue_size: int = 1000,
+                 max_retries: int = 5,
+                 backoff: float = 2,
+                 metrics: Union[None, Metrics] = None):
+        """
+        Send the notifications from a background thread, so that the scraping threads never wait for them.
+        Items that arrive within digest_window seconds are sent together, in one notification per keyword.
+        :param gmail_sender: Email notifications (optional).
+        :param alertzy: Alertzy notifications (optional).
+        :param digest_window: Number of seconds to wait for other items before sending a notification.
+        :param max_queue_size: Maximum number of pending items. New items are dropped when the queue is full.
+        :param max_retries: Number of retries when a notification fails.
+        :param backoff: Initial number of seconds between two retries (doubled at every retry).
+        :param metrics: Where to record the queue size, the delays and the duration of the sends (optional).
+        """
+        self.gmail_sender = gmail_sender
+        self.alertzy = alertzy
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._stats_lock = threading.Lock()
+        self._stats = {'submitted': 0, 'dropped': 0, 'sent_items': 0, 'sent_notifications': 0,
+                       'retries': 0, 'failures': 0, 'max_queue_size': 0, 'last_delay': 0.0}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Union[None, float] = None):
+        """
+        Send the pending notifications and stop the background thread.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self.gmail_sender is not None:
+            self.gmail_sender.close()
+
+    def submit(self, keyword: str, item: Item) -> bool:
+        """
+        :param keyword: Keyword that matched the item (title of the notification).
+        :param item: The new item.
+        :rtype: False if the queue is full and the item was dropped.
+        """
+        try:
+            self._queue.put_nowait((keyword, item, time.time()))
+        except queue.Full:
+            logger.warning(f'Notification queue is full. Dropping {item.url}.')
+            self._increment('dropped')
+            return False
+        self._increment('submitted')
+        with self._stats_lock:
+            self._stats['max_queue_size'] = max(self._stats['max_queue_size'], self._queue.qsize())
+        if self.metrics is not None:
+            self.metrics.set('notification_queue_size', self._queue.qsize())
+        return True
+
+    def stats(self) -> dict:
+        """
+        :rtype: Counters of the dispatcher. queue_size and max_queue_size show the backpressure.
+        """
+        with self._stats_lock:
+            return {**self._stats, 'queue_size': self._queue.qsize()}
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.time() + self.digest_window
+            while True:
+                try:
+                    notification = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if notification is None:
+                    stopping = True
+                    break
+                batch.append(notification)
+            by_keyword = {}
+            for keyword, item, submitted_at in batch:
+                # the same item can be submitted by several subscribers of the same keyword.
+                if item.url not in [i.url for i, _ in by_keyword.get(keyword, [])]:
+                    by_keyword.setdefault(keyword, []).append((item, submitted_at))
+            if self.metrics is not None:
+                self.metrics.set('notification_queue_size', self._queue.qsize())
+            for keyword, items in by_keyword.items():
+                self._send(keyword, [item for item, _ in items])
+                delay = time.time() - min(submitted_at for _, submitted_at in items)
+                self._set('last_delay', delay)
+                if self.metrics is not None:
+                    self.metrics.observe('notification_delay_seconds', delay)
+
+    def _send(self, keyword: str, items: List[Item]):
+        if len(items) == 1:
+            item = items[0]
+            email_subject = f'{item.name} {item.price}'
+            email_content = f'{item.url}<br/><br/>{item.desc}'
+            alertzy_message = f'{email_subject} {item.url}'
+        else:
+            email_subject = f'{len(items)} new items for {keyword}'
+            email_content = '<br/><br/>'.join(f'{item.name} {item.price}<br/>{item.url}<br/><br/>{item.desc}'
+                                              for item in items)
+            alertzy_message = '\n'.join(f'{item.name} {item.price} {item.url}' for item in items)
+
+        def send_alertzy():
+            if not self.alertzy.send_notification(alertzy_message, title=keyword):
+                raise ConnectionError('Alertzy notification failed.')
+
+        def send_gmail():
+            self.gmail_sender.send_email_notification(email_subject, email_content, attachments)
+
+        sent = False
+        if _enabled(self.alertzy):
+            logger.info('Will send an Alertzy notification.')
+            sent |= self._with_retries(keyword, 'Alertzy', send_alertzy)
+        else:
+            logger.info('Will skip Alertzy.')
+        if _enabled(self.gmail_sender):
+            logger.info('Will send a GMAIL notification.')
+            # downloaded once: only the SMTP send is retried.
+            attachments = _attachments(items)
+            sent |= self._with_retries(keyword, 'GMAIL', send_gmail)
+        else:
+            logger.info('Will skip GMAIL.')
+        if sent:
+            self._increment('sent_notifications')
+            self._increment('sent_items', len(items))
+
+    def _with_retries(self, keyword: str, channel: str, send) -> bool:
+        for attempt in range(self.max_retries + 1):
+            start = time.time()
+            try:
+                send()
+                self._observe_send(channel, 'ok', time.time() - start)
+                return True
+            except Exception:
+                self._observe_send(channel, 'error', time.time() - start)
+                if attempt == self.max_retries:
+                    logger.exception(f'[{keyword}] Could not send the {channel} notification.')
+                    self._increment('failures')
+                    return False
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f'[{keyword}] {channel} notification failed. Retrying in {delay} seconds.')
+                self._increment('retries')
+                time.sleep(delay)
+        return False
+
+    def _observe_send(self, channel: str, result: str, duration: float):
+        if self.metrics is not None:
+            self.metrics.observe('notification_send_seconds', duration, {'channel': channel, 'result': result})
+
+    def _increment(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self._stats[name] += value
+        if self.metrics is not None:
+            self.metrics.increment(f'notifications_{name}_total', value)
+
+    def _set(self, name: str, value):
+        with self._stats_lock:
+            self._stats[name] = value
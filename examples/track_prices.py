@@ -0,0 +1,54 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from mercari import Mercari, Rakuma, RateLimiter
+from mercari.price_history import PriceHistory
+
+logger = logging.getLogger(__name__)
+
+
+def get_script_arguments():
+    parser = argparse.ArgumentParser(description='Record the price and the status of the items matching keywords '
+                                                 'at regular intervals, and report the price drops.')
+    parser.add_argument('--keywords', required=True, type=str, help='Keywords separated by a comma.')
+    parser.add_argument('--history', default='price_history', type=str, help='Directory of the price history.')
+    parser.add_argument('--max_items', default=500, type=int, help='Maximum number of items per keyword and website.')
+    parser.add_argument('--interval', default=3600, type=float, help='Number of seconds between two snapshots.')
+    parser.add_argument('--min_drop', default=0.2, type=float, help='Price drops reported (fraction of the price).')
+    parser.add_argument('--requests_per_second', default=1.0, type=float,
+                        help='Maximum number of requests per second to each website.')
+    args = parser.parse_args()
+    logger.info(args)
+    return args
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    args = get_script_arguments()
+    keywords = [keyword.strip() for keyword in args.keywords.strip().split(',')]
+    rate_limiter = RateLimiter(rate=args.requests_per_second, burst=2)
+    backends = [Mercari(rate_limiter=rate_limiter), Rakuma(rate_limiter=rate_limiter)]
+    history = PriceHistory(args.history)
+    while True:
+        start = time.time()
+        for keyword in keywords:
+            for backend in backends:
+                # the search pages are enough: no item page is fetched.
+                listings = list(backend.iter_listings(keyword, max_items_to_fetch=args.max_items, prefetch=2))
+                history.add_items(listings, timestamp=start, keyword=keyword)
+                logger.info(f'[{keyword}] {len(listings)} items on {backend.name}.')
+        history.flush()
+        for drop in history.price_drops(args.min_drop, since=start - 24 * 3600):
+            logger.info(f'[{drop["keyword"]}] {drop["marketplace"]} {drop["item_id"]}: '
+                        f'{drop["price_before"]} -> {drop["price"]} yen (-{drop["drop"]:.0%}).')
+        for keyword, durations in history.time_to_sell().items():
+            logger.info(f'[{keyword}] {len(durations)} items sold, median time to sell: '
+                        f'{np.median(durations) / 3600:.1f} hours.')
+        time.sleep(max(0.0, start + args.interval - time.time()))
+
+
+if __name__ == '__main__':
+    main()
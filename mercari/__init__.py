@@ -1,3 +1,13 @@
-from mercari.common import Item
+from mercari.common import Item, Listing, HighWaterMark, download_photos
+from mercari.common import SORT_RELEVANCE, SORT_NEWEST, SORT_PRICE_ASC, SORT_PRICE_DESC
+from mercari.common import MAX_PRICE
 from mercari.mercari import Mercari
 from mercari.rakuma import Rakuma
+from mercari.session import build_session
+from mercari.photo_cache import PhotoCache
+from mercari.rate_limit import RateLimiter, TokenBucket
+from mercari.item_cache import ItemCache, MemoryItemCache, SQLiteItemCache
+from mercari.seen_store import SeenStore
+from mercari.scheduler import PollScheduler
+from mercari.metrics import Metrics, serve_metrics
+from mercari.crawl import bulk_crawl, work_units, split_prices, WorkUnit, SharedRateLimiter
@@ -0,0 +1,641 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import List, Any, Union, AsyncIterator, Tuple, Dict, Mapping
+from urllib.parse import urlparse
+
+import aiohttp
+
+from mercari.common import Common, Item, Listing, HighWaterMark, PAGINATION_RATE, SORT_RELEVANCE, SORT_NEWEST
+# noinspection PyProtectedMember
+from mercari.common import PriceBand, _split_band
+from mercari.item_cache import ItemCache
+from mercari.metrics import Metrics, timed
+from mercari.photo_cache import PhotoCache
+from mercari.rate_limit import RateLimiter, TokenBucket
+from mercari.mercari import Mercari
+from mercari.rakuma import Rakuma
+from mercari.session import DEFAULT_HEADERS, DEFAULT_TIMEOUT, RETRY_STATUSES
+
+logger = logging.getLogger(__name__)
+
+
+def build_async_session(limit: int = 100,
+                        limit_per_host: int = 10,
+                        metrics: Union[None, Metrics] = None) -> aiohttp.ClientSession:
+    """
+    Build an asynchronous HTTP client. Must be called from a running event loop.
+    :param limit: Maximum number of simultaneous connections.
+    :param limit_per_host: Maximum number of simultaneous connections to the same host.
+    :param metrics: Where to record the time spent waiting for a free connection, connecting and resolving
+    the host names (optional).
+    :rtype: aiohttp.ClientSession.
+    """
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+    timeout = aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT)
+    trace_configs = [_trace_config(metrics)] if metrics is not None else None
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=DEFAULT_HEADERS,
+                                 trace_configs=trace_configs)
+
+
+def _trace_config(metrics: Metrics) -> aiohttp.TraceConfig:
+    # each request has its own context, where the start times are kept.
+    trace_config = aiohttp.TraceConfig()
+
+    def started(name: str):
+        async def on_start(session, context: SimpleNamespace, params):
+            setattr(context, name, time.perf_counter())
+
+        return on_start
+
+    def ended(name: str):
+        async def on_end(session, context: SimpleNamespace, params):
+            metrics.observe(name, time.perf_counter() - getattr(context, name), {'host': context.host})
+
+        return on_end
+
+    async def on_request_start(session, context: SimpleNamespace, params):
+        context.host = params.url.host
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_queued_start.append(started('connection_queue_seconds'))
+    trace_config.on_connection_queued_end.append(ended('connection_queue_seconds'))
+    trace_config.on_connection_create_start.append(started('connect_seconds'))
+    trace_config.on_connection_create_end.append(ended('connect_seconds'))
+    trace_config.on_dns_resolvehost_start.append(started('dns_seconds'))
+    trace_config.on_dns_resolvehost_end.append(ended('dns_seconds'))
+    return trace_config
+
+
+class AsyncCommon:
+    backend_cls = Common
+
+    def __init__(self,
+                 session: Union[None, aiohttp.ClientSession] = None,
+                 limit: int = 100,
+                 limit_per_host: int = 10,
+                 photo_cache: Union[None, PhotoCache] = None,
+                 rate_limiter: Union[None, RateLimiter] = None,
+                 item_cache: Union[None, ItemCache] = None,
+                 metrics: Union[None, Metrics] = None,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5):
+        """
+        :param session: Asynchronous HTTP client, can be shared between backends (optional).
+        If not provided, one is created on first use with the given connection limits and closed by close().
+        :param limit: Maximum number of simultaneous connections (if session is not provided).
+        :param limit_per_host: Maximum number of simultaneous connections per host (if session is not provided).
+        :param photo_cache: On-disk cache for the photos of the items (optional). Defaults to the shared photo cache.
+        :param rate_limiter: Per-marketplace rate limit applied to all the page requests (optional).
+        :param item_cache: Cache in front of get_item_info() (optional). See MemoryItemCache and SQLiteItemCache.
+        :param metrics: Where to record the timings of the requests and of the parsing (optional).
+        The connection timings are only recorded if the session is created here (see build_async_session()).
+        :param max_retries: Number of retries of the page requests on connection errors and 429/5xx responses.
+        :param backoff_factor: Exponential backoff factor between two retries (in seconds). See build_session().
+        """
+        self.session = session
+        self._owns_session = session is None
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # The synchronous backend holds the URL building and the HTML parsing. It never opens its HTTP session.
+        self._backend = self.backend_cls(photo_cache=photo_cache, item_cache=item_cache, metrics=metrics)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch_all_items(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = 100,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
+    ) -> List[str]:  # list of URLs.
+        """
+        See Common.fetch_all_items().
+        """
+        return [item async for item in self.iter_items(keyword, price_min, price_max, max_items_to_fetch, prefetch,
+                                                       sort)]
+
+    def iter_items(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
+    ) -> AsyncIterator[str]:  # URLs.
+        """
+        See Common.iter_items().
+        """
+        return _limit(self._iter_pages(keyword, price_min, price_max, prefetch, sort), max_items_to_fetch)
+
+    def iter_listings(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
+    ) -> AsyncIterator[Listing]:
+        """
+        See Common.iter_listings().
+        """
+        pages = self._iter_pages(keyword, price_min, price_max, prefetch, sort, listings=True)
+        return _limit(pages, max_items_to_fetch)
+
+    async def fetch_items_pagination(
+            self,
+            keyword: str,
+            page_id: Union[None, int] = None,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
+    ) -> Union[List[str], Any]:  # List of URLS and a HTML marker.
+        """
+        See Common.fetch_items_pagination().
+        """
+        if page_id is None:
+            page_id = self._backend.first_page_id
+        url = self._backend._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max, sort=sort)
+        _, content, headers = await self._get(url)
+        return self._backend._parse_search(content, headers.get('Content-Type'))
+
+    async def fetch_listings_pagination(
+            self,
+            keyword: str,
+            page_id: Union[None, int] = None,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
+    ) -> Union[List[Listing], Any]:  # List of listings and a HTML marker.
+        """
+        See Common.fetch_listings_pagination().
+        """
+        if page_id is None:
+            page_id = self._backend.first_page_id
+        url = self._backend._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max, sort=sort)
+        _, content, headers = await self._get(url)
+        return self._backend._parse_search(content, headers.get('Content-Type'), listings=True)
+
+    async def fetch_new_items(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: int = 1000
+    ) -> List[str]:  # list of URLs.
+        """
+        See Common.fetch_new_items().
+        """
+        return await self._fetch_new(keyword, high_water_mark, price_min, price_max, max_items_to_fetch)
+
+    async def fetch_new_listings(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: int = 1000
+    ) -> List[Listing]:
+        """
+        See Common.fetch_new_listings().
+        """
+        return await self._fetch_new(keyword, high_water_mark, price_min, price_max, max_items_to_fetch, listings=True)
+
+    async def _fetch_new(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            max_items_to_fetch: int,
+            listings: bool = False
+    ) -> list:
+        # see Common._fetch_new().
+        new_items = []
+        seen = set()
+        pages = self._iter_pages(keyword, price_min, price_max, prefetch=1, sort=SORT_NEWEST, listings=listings)
+        try:
+            async for items, _ in pages:
+                for item in items:
+                    item_id = self._backend._listing_id(item)
+                    if item_id in high_water_mark:
+                        break
+                    if len(new_items) >= max_items_to_fetch:
+                        logger.warning(f'[{keyword}] More than {max_items_to_fetch} new items, some are skipped.')
+                        break
+                    if item_id not in seen:
+                        seen.add(item_id)
+                        new_items.append(item)
+                else:
+                    if len(high_water_mark) > 0:
+                        continue
+                break
+        finally:
+            await pages.aclose()
+        high_water_mark.update([self._backend._listing_id(item) for item in new_items])
+        return new_items
+
+    async def price_bands(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> List[PriceBand]:
+        """
+        See Common.price_bands().
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+        page_limiter = self._sharding_limiter(max_workers)
+        bands = []
+        probes = {}
+        for band in _split_band(price_min, price_max, False):
+            probes[asyncio.ensure_future(self._probe_band(keyword, band, False, page_limiter, semaphore))] = band
+        try:
+            while len(probes) > 0:
+                done, _ = await asyncio.wait(probes, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    band = probes.pop(task)
+                    _, too_large = task.result()
+                    sub_bands = _split_band(*band, too_large)
+                    if len(sub_bands) == 1:
+                        bands.append(band)
+                        continue
+                    for sub_band in sub_bands:
+                        probe = self._probe_band(keyword, sub_band, False, page_limiter, semaphore)
+                        probes[asyncio.ensure_future(probe)] = sub_band
+        finally:
+            for task in probes:
+                task.cancel()
+        return sorted(bands)
+
+    def iter_items_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> AsyncIterator[str]:
+        """
+        See Common.iter_items_sharded().
+        """
+        return self._iter_sharded(keyword, price_min, price_max, max_items_to_fetch, max_workers, listings=False)
+
+    def iter_listings_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> AsyncIterator[Listing]:
+        """
+        See Common.iter_listings_sharded().
+        """
+        return self._iter_sharded(keyword, price_min, price_max, max_items_to_fetch, max_workers, listings=True)
+
+    async def _iter_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            max_items_to_fetch: Union[None, int],
+            max_workers: int,
+            listings: bool
+    ) -> AsyncIterator[Union[str, Listing]]:
+        # see Common._iter_sharded().
+        semaphore = asyncio.Semaphore(max_workers)
+        page_limiter = self._sharding_limiter(max_workers)
+        seen = set()
+        probes, crawls = {}, set()
+        for band in _split_band(price_min, price_max, False):
+            probes[asyncio.ensure_future(self._probe_band(keyword, band, listings, page_limiter, semaphore))] = band
+        try:
+            while len(probes) + len(crawls) > 0:
+                done, _ = await asyncio.wait(set(probes) | crawls, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task in crawls:
+                        crawls.remove(task)
+                        for item in task.result():
+                            item_id = self._backend._listing_id(item)
+                            if item_id in seen:
+                                continue
+                            if max_items_to_fetch is not None and len(seen) >= max_items_to_fetch:
+                                return
+                            seen.add(item_id)
+                            yield item
+                        continue
+                    band = probes.pop(task)
+                    first_page, too_large = task.result()
+                    sub_bands = _split_band(*band, too_large)
+                    if len(sub_bands) == 1:
+                        crawl = self._crawl_band(keyword, band, first_page, listings, page_limiter, semaphore)
+                        crawls.add(asyncio.ensure_future(crawl))
+                        continue
+                    for sub_band in sub_bands:
+                        probe = self._probe_band(keyword, sub_band, listings, page_limiter, semaphore)
+                        probes[asyncio.ensure_future(probe)] = sub_band
+        finally:
+            for task in list(probes) + list(crawls):
+                task.cancel()
+
+    def _sharding_limiter(self, max_workers: int) -> Union[None, TokenBucket]:
+        # see Common._sharding_limiter().
+        return TokenBucket(PAGINATION_RATE * max_workers) if self.rate_limiter is None else None
+
+    async def _probe_band(
+            self,
+            keyword: str,
+            band: PriceBand,
+            listings: bool,
+            page_limiter: Union[None, TokenBucket],
+            semaphore: asyncio.Semaphore
+    ) -> Tuple[Tuple[list, Any], bool]:
+        # see Common._probe_band().
+        backend = self._backend
+        fetch_pagination = self.fetch_listings_pagination if listings else self.fetch_items_pagination
+        async with semaphore:
+            if page_limiter is not None:
+                await page_limiter.acquire_async()
+            items, marker = await fetch_pagination(keyword, backend.first_page_id, *band)
+            if backend._is_last_page(items, marker):
+                return (items, marker), False
+            num_results = backend._count_results(items, marker)
+            if num_results is not None:
+                return (items, marker), num_results > len(items) * backend.max_search_pages
+            if page_limiter is not None:
+                await page_limiter.acquire_async()
+            last_page_id = backend.first_page_id + backend.max_search_pages - 1
+            deepest_items, deepest_marker = await fetch_pagination(keyword, last_page_id, *band)
+            return (items, marker), not backend._is_last_page(deepest_items, deepest_marker)
+
+    async def _crawl_band(
+            self,
+            keyword: str,
+            band: PriceBand,
+            first_page: Tuple[list, Any],
+            listings: bool,
+            page_limiter: Union[None, TokenBucket],
+            semaphore: asyncio.Semaphore
+    ) -> list:
+        # see Common._crawl_band().
+        items, marker = first_page
+        if self._backend._is_last_page(items, marker):
+            return items
+        items = list(items)
+        async with semaphore:
+            pages = self._iter_pages(keyword, *band, listings=listings, page_id=self._backend.first_page_id + 1,
+                                     page_limiter=page_limiter)
+            try:
+                async for page_items, _ in pages:
+                    items.extend(page_items)
+            finally:
+                await pages.aclose()
+        return items
+
+    async def get_item_info(
+            self,
+            item_url: str
+    ) -> Item:
+        """
+        See Common.get_item_info().
+        """
+        item_cache = self._backend.item_cache
+        if item_cache is None:
+            _, content, headers = await self._get(item_url)
+            return self._backend._parse_item(content, headers.get('Content-Type'), item_url)
+        item = item_cache.get(item_url)
+        result = 'hit'
+        if item is None:
+            status, content, headers = await self._get(item_url, item_cache.validators(item_url))
+            if status == 304:
+                item = item_cache.revalidated(item_url)
+                result = 'revalidated'
+            if item is None:
+                result = 'miss'
+                if status != 200:  # 304 but the entry was evicted in the meantime.
+                    status, content, headers = await self._get(item_url)
+                item = self._backend._parse_item(content, headers.get('Content-Type'), item_url)
+                item_cache.put(item_url, item, headers)
+        if self.metrics is not None:
+            self.metrics.increment('cache_requests_total', labels={'cache': 'item', 'result': result})
+        return self._backend._attach(item)
+
+    async def get_item_infos(
+            self,
+            item_urls: List[str],
+            max_workers: int = 8,
+            rate_limit: Union[None, float] = None
+    ) -> List[Union[Item, Exception]]:
+        """
+        See Common.get_item_infos().
+        """
+        results = dict([result async for result in self.iter_item_infos(item_urls, max_workers, rate_limit)])
+        return [results[item_url] for item_url in item_urls]
+
+    async def iter_item_infos(
+            self,
+            item_urls: List[str],
+            max_workers: int = 8,
+            rate_limit: Union[None, float] = None
+    ) -> AsyncIterator[Tuple[str, Union[Item, Exception]]]:
+        """
+        See Common.iter_item_infos().
+        """
+        batch_limiter = RateLimiter(rate_limit) if rate_limit is not None else None
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch_item(item_url: str) -> Tuple[str, Union[Item, Exception]]:
+            async with semaphore:
+                if batch_limiter is not None:
+                    await batch_limiter.acquire_async(item_url)
+                try:
+                    return item_url, await self.get_item_info(item_url)
+                except Exception as e:
+                    logger.warning(f'Could not fetch {item_url}: {e!r}.')
+                    return item_url, e
+
+        tasks = [asyncio.ensure_future(fetch_item(item_url)) for item_url in set(item_urls)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _iter_pages(
+            self,
+            keyword: str,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE,
+            listings: bool = False,
+            page_id: Union[None, int] = None,
+            page_limiter: Union[None, TokenBucket] = None
+    ) -> AsyncIterator[Tuple[List[Union[str, Listing]], Any]]:
+        # see Common._iter_pages().
+        if page_limiter is None and self.rate_limiter is None:
+            page_limiter = TokenBucket(PAGINATION_RATE)
+        fetch_pagination = self.fetch_listings_pagination if listings else self.fetch_items_pagination
+
+        async def fetch_page(page_id: int):
+            if page_limiter is not None:
+                await page_limiter.acquire_async()
+            return await fetch_pagination(keyword, page_id, price_min, price_max, sort)
+
+        pending = deque()
+        next_page_id = self._backend.first_page_id if page_id is None else page_id
+        try:
+            while True:
+                while len(pending) < prefetch:
+                    pending.append(asyncio.ensure_future(fetch_page(next_page_id)))
+                    next_page_id += 1
+                items, marker = await pending.popleft()
+                yield items, marker
+                if self._backend._is_last_page(items, marker):
+                    return
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def download_photos(self, items: List[Item], max_workers: int = 8) -> List[str]:
+        """
+        Download the photos of many items concurrently. Items that already have a local photo are skipped.
+        :param items: List of Item objects.
+        :param max_workers: Maximum number of simultaneous downloads.
+        :rtype: List of local paths, in the same order as items.
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def download(item: Item) -> str:
+            if item._local_url is None:
+                async with semaphore:
+                    item.local_url = await self._download_photo(item.url_photo)
+            return item.local_url
+
+        return list(await asyncio.gather(*[download(item) for item in items]))
+
+    async def _download_photo(self, url_photo: str) -> str:
+        photo_cache = self._backend.photo_cache
+        local_url = photo_cache.get(url_photo)
+        if local_url is not None:
+            photo_cache.record('hit')
+            return local_url
+        start = time.perf_counter()
+        response = await self._get_session().get(url_photo, headers=photo_cache.validators(url_photo))
+        ttfb = time.perf_counter() - start
+        if response.status == 304:
+            response.release()
+            local_url = photo_cache.revalidated(url_photo)
+            if local_url is not None:
+                photo_cache.record('revalidated', url_photo, 304, 0, ttfb, time.perf_counter() - start)
+                return local_url
+            # 304 but the entry was evicted in the meantime.
+            start = time.perf_counter()
+            response = await self._get_session().get(url_photo)
+            ttfb = time.perf_counter() - start
+        async with response:
+            if response.status != 200:
+                photo_cache.record('miss', url_photo, response.status, 0, ttfb, time.perf_counter() - start)
+                logger.error(response)
+                raise ConnectionError()
+            content = await response.read()
+            local_url = photo_cache.put(url_photo, content, response.headers)
+            photo_cache.record('miss', url_photo, 200, len(content), ttfb, time.perf_counter() - start)
+            return local_url
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = build_async_session(self._limit, self._limit_per_host, self.metrics)
+        return self.session
+
+    async def _get(self, url: str, headers: Union[None, Dict[str, str]] = None) -> Tuple[int, bytes, Mapping]:
+        # see mercari.common._get(). Returns the status, the body and the headers of the response.
+        # the connection errors and the 429/5xx responses are retried like in build_session().
+        host = urlparse(url).netloc
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                with timed(self.metrics, 'rate_limit_wait_seconds', {'host': host}):
+                    await self.rate_limiter.acquire_async(url)
+            logger.info(f'GET: {url}')
+            start = time.perf_counter()
+            try:
+                async with self._get_session().get(url, headers=headers) as response:
+                    ttfb = time.perf_counter() - start
+                    content = await response.read()
+                    if self.metrics is not None:
+                        self.metrics.record_request(host, response.status, len(content), ttfb,
+                                                    time.perf_counter() - start - ttfb)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f'GET: {url} failed: {e!r}.')
+                await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+                continue
+            if response.status not in RETRY_STATUSES or attempt == self.max_retries:
+                break
+            logger.warning(f'GET: {url} returned {response.status}.')
+            await asyncio.sleep(_retry_delay(response.headers, self.backoff_factor * 2 ** attempt))
+        if response.status != 200 and not (response.status == 304 and headers):
+            logger.error(response)
+            raise ConnectionError()
+        return response.status, content, response.headers
+
+    @property
+    def name(self) -> str:
+        return self._backend.name
+
+
+def _retry_delay(headers: Mapping, backoff: float) -> float:
+    # the Retry-After header (in seconds) of a 429/503 response is respected, like urllib3 does.
+    try:
+        return max(backoff, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return backoff
+
+
+async def _limit(pages: AsyncIterator[Tuple[list, Any]], max_items_to_fetch: Union[None, int]) -> AsyncIterator:
+    # see mercari.common._limit().
+    count = 0
+    try:
+        async for items, _ in pages:
+            for item in items:
+                if max_items_to_fetch is not None and count >= max_items_to_fetch:
+                    logger.debug(f'Reached the maximum items to fetch: {max_items_to_fetch}.')
+                    return
+                count += 1
+                yield item
+            logger.debug(f'Found {count} items so far.')
+        logger.debug('No more items to fetch.')
+    finally:
+        await pages.aclose()
+
+
+class AsyncMercari(AsyncCommon):
+    backend_cls = Mercari
+
+
+class AsyncRakuma(AsyncCommon):
+    backend_cls = Rakuma
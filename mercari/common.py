@@ -1,21 +1,54 @@
 import logging
-import tempfile
-from pathlib import Path
-from typing import List, Any, Union
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from typing import List, Any, Union, Iterator, Tuple, Dict, TYPE_CHECKING
 from urllib.parse import urlparse
 
 import requests
-import wget
-from bs4 import BeautifulSoup
+from lxml import html
+
+from mercari.metrics import Metrics, timed
+from mercari.photo_cache import PhotoCache, default_photo_cache
+from mercari.rate_limit import RateLimiter, TokenBucket
+from mercari.session import build_session, DEFAULT_HEADERS, DEFAULT_TIMEOUT
+
+if TYPE_CHECKING:
+    from mercari.item_cache import ItemCache
 
 logger = logging.getLogger(__name__)
 
+# Default pace of the pagination when the backend has no rate limiter: one page every 2 seconds.
+PAGINATION_RATE = 0.5
+
+# Orders of the search results, see Common.fetch_all_items().
+SORT_RELEVANCE = 'relevance'
+SORT_NEWEST = 'newest'
+SORT_PRICE_ASC = 'price_asc'
+SORT_PRICE_DESC = 'price_desc'
+
+# Highest price of an item in yen. Upper bound of the sharded searches, see Common.iter_items_sharded().
+MAX_PRICE = 9999999
+
+PriceBand = Tuple[int, int]
+
 
 class Item:
+    __slots__ = ('name', 'price', 'desc', 'sold_out', 'url_photo', 'url', 'marketplace',
+                 '_session', '_local_url', '_photo_cache')
+
+    # Serialized fields, see to_dict().
+    fields = ('name', 'price', 'desc', 'sold_out', 'url_photo', 'url', 'marketplace', 'local_url')
 
     def __init__(self,
                  name: str, price: Union[int, str], desc: str,
-                 sold_out: bool, url_photo: str, url: str):
+                 sold_out: bool, url_photo: str, url: str,
+                 session: Union[None, requests.Session] = None,
+                 local_url: Union[None, str] = None,
+                 photo_cache: Union[None, PhotoCache] = None,
+                 marketplace: str = ''):
         """
         :param name: Name of the item (String).
         :param price: Price (Integer)
@@ -23,6 +56,11 @@ class Item:
         :param sold_out: If the item was sold (Boolean).
         :param url_photo: URL to the photo (String).
         :param url: Local path to the downloaded photo (String).
+        :param session: HTTP session used to download the photo (optional).
+        :param local_url: Local path to the photo if it was already downloaded (optional).
+        The photo is downloaded on the first access to local_url. Use download_photos() for many items at once.
+        :param photo_cache: Where to store the photo (optional). Defaults to the shared photo cache.
+        :param marketplace: Name of the backend the item comes from, e.g. mercari (String).
         """
         self.name = name
         self.price = int(price)
@@ -30,21 +68,157 @@ class Item:
         self.sold_out = sold_out
         self.url_photo = url_photo
         self.url = url
-        self.local_url = _download_photo(self.url_photo)
+        self.marketplace = sys.intern(marketplace)
+        self._session = session
+        self._local_url = local_url
+        self._photo_cache = photo_cache
+
+    @property
+    def local_url(self) -> str:
+        if self._local_url is None:
+            self._local_url = _download_photo(self.url_photo, session=self._session, photo_cache=self._photo_cache)
+        return self._local_url
+
+    @local_url.setter
+    def local_url(self, local_url: str):
+        self._local_url = local_url
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'price': self.price,
+            'desc': self.desc,
+            'sold_out': self.sold_out,
+            'url_photo': self.url_photo,
+            'url': self.url,
+            'marketplace': self.marketplace,
+            'local_url': self._local_url
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict, **kwargs) -> 'Item':
+        """
+        :param d: Dictionary returned by to_dict().
+        :param kwargs: Other arguments of the constructor (e.g. session).
+        :rtype: Item: The Item object.
+        """
+        return cls(**d, **kwargs)
 
     def __str__(self) -> str:
+        # does not trigger the download of the photo.
         return f'(name={self.name}, price={self.price}, desc={self.desc.strip()}, sold_out={self.sold_out},' \
-               f'url_photo={self.url_photo}, url={self.url}, local_url={self.local_url})'
+               f'url_photo={self.url_photo}, url={self.url}, local_url={self._local_url})'
+
+
+class Listing:
+    __slots__ = ('item_id', 'url', 'name', 'price', 'sold_out', 'url_thumbnail', 'marketplace')
+
+    # Serialized fields, see to_dict().
+    fields = __slots__
+
+    def __init__(self,
+                 item_id: str, url: str, name: str, price: Union[int, str],
+                 sold_out: bool, url_thumbnail: str, marketplace: str = ''):
+        """
+        Summary of an item, as shown on the search pages. Use Common.get_item_info() for the description and the photo.
+        :param item_id: ID of the item on its marketplace (String).
+        :param url: URL of the item page (String).
+        :param name: Name of the item (String).
+        :param price: Price (Integer).
+        :param sold_out: If the item was sold (Boolean).
+        :param url_thumbnail: URL to the thumbnail of the photo (String).
+        :param marketplace: Name of the backend the item comes from, e.g. mercari (String).
+        """
+        self.item_id = item_id
+        self.url = url
+        self.name = name
+        self.price = int(price)
+        self.sold_out = sold_out
+        self.url_thumbnail = url_thumbnail
+        self.marketplace = sys.intern(marketplace)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __str__(self) -> str:
+        return f'(name={self.name}, price={self.price}, sold_out={self.sold_out}, url={self.url})'
+
+
+class HighWaterMark:
+
+    def __init__(self, item_ids: Union[None, List[str]] = None, size: int = 10):
+        """
+        Newest items seen by a query, see Common.fetch_new_items(). Several items are kept
+        in case the newest one is deleted by its seller.
+        :param item_ids: IDs of the newest items seen, newest first (optional).
+        :param size: Number of item IDs to keep.
+        """
+        self.size = size
+        self.item_ids = list(item_ids or [])[:size]
+
+    def update(self, item_ids: List[str]):
+        """
+        :param item_ids: IDs of the new items, newest first.
+        """
+        self.item_ids = (list(item_ids) + [i for i in self.item_ids if i not in item_ids])[:self.size]
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.item_ids
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
 
 
 class Common:
 
+    def __init__(self,
+                 session: Union[None, requests.Session] = None,
+                 photo_cache: Union[None, PhotoCache] = None,
+                 rate_limiter: Union[None, RateLimiter] = None,
+                 item_cache: Union[None, 'ItemCache'] = None,
+                 metrics: Union[None, Metrics] = None):
+        """
+        :param session: HTTP session shared by all the requests of this backend (optional).
+        A pooled session with keep-alive and retries is created on first use if not provided. See build_session().
+        :param photo_cache: On-disk cache for the photos of the items (optional). Defaults to the shared photo cache.
+        :param rate_limiter: Per-marketplace rate limit applied to all the page requests (optional).
+        :param item_cache: Cache in front of get_item_info() (optional). See MemoryItemCache and SQLiteItemCache.
+        :param metrics: Where to record the timings of the requests and of the parsing (optional).
+        """
+        self._session = session
+        self._session_lock = threading.Lock()
+        self.photo_cache = photo_cache if photo_cache is not None else default_photo_cache()
+        self.rate_limiter = rate_limiter
+        self.item_cache = item_cache
+        self.metrics = metrics
+
+    @property
+    def session(self) -> requests.Session:
+        # created on first use: the backends only used for their parsers (see mercari.aio) never open one.
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = build_session()
+        return self._session
+
+    @session.setter
+    def session(self, session: requests.Session):
+        self._session = session
+
+    # Index of the first page of the search results.
+    first_page_id = 0
+
+    # Number of pages of search results that can be fetched: the results beyond are cut by the marketplace.
+    max_search_pages = 100
+
     def fetch_all_items(
             self,
             keyword: str,
-            price_min: Union[None, int],
-            price_max: Union[None, int],
-            max_items_to_fetch: Union[None, int] = 100
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = 100,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
     ) -> List[str]:  # list of URLs.
         """
         :rtype: A list of URL (Strings).
@@ -52,24 +226,334 @@ class Common:
         :param price_min: Minimum price in yen (optional).
         :param price_max: Maximum price in yen (optional).
         :param max_items_to_fetch: Maximum number of items to return (optional).
+        :param prefetch: Number of pages fetched concurrently (optional). Requests are paced by the rate limiter
+        of the backend, or at PAGINATION_RATE pages per second if there is none.
+        :param sort: Order of the results: SORT_RELEVANCE, SORT_NEWEST, SORT_PRICE_ASC or SORT_PRICE_DESC.
         """
-        pass
+        return list(self.iter_items(keyword, price_min, price_max, max_items_to_fetch, prefetch, sort))
+
+    def iter_items(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
+    ) -> Iterator[str]:  # URLs.
+        """
+        Same as fetch_all_items() but the URLs are yielded as soon as their page is parsed.
+        Exactly max_items_to_fetch URLs are yielded (unless there are fewer results).
+        :rtype: Iterator of URL (Strings).
+        """
+        return _limit(self._iter_pages(keyword, price_min, price_max, prefetch, sort), max_items_to_fetch)
+
+    def iter_listings(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
+    ) -> Iterator[Listing]:
+        """
+        Same as iter_items() but yields the summaries of the items shown on the search pages (name, price...).
+        :rtype: Iterator of Listing objects.
+        """
+        pages = self._iter_pages(keyword, price_min, price_max, prefetch, sort, listings=True)
+        return _limit(pages, max_items_to_fetch)
 
     def fetch_items_pagination(
             self,
             keyword: str,
-            page_id: int,
-            price_min: Union[None, int],
-            price_max: Union[None, int]
+            page_id: Union[None, int] = None,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
     ) -> Union[List[str], Any]:  # List of URLS and a HTML marker.
         """
         :param keyword: Keyword for the search (required).
-        :param page_id: The page id for the pagination (e.g. 0, 1, 2...)
+        :param page_id: The page id for the pagination (e.g. 0, 1, 2...). Defaults to the first page.
         :param price_min: Minimum price in yen (optional).
         :param price_max: Maximum price in yen (optional).
+        :param sort: Order of the results, see fetch_all_items().
         :rtype: List of URLS and a HTML marker.
         """
-        pass
+        if page_id is None:
+            page_id = self.first_page_id
+        url = self._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max, sort=sort)
+        response = _get(url, self.session, self.rate_limiter, metrics=self.metrics)
+        return self._parse_search(response.content, response.headers.get('Content-Type'))
+
+    def fetch_listings_pagination(
+            self,
+            keyword: str,
+            page_id: Union[None, int] = None,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
+    ) -> Union[List[Listing], Any]:  # List of listings and a HTML marker.
+        """
+        Same as fetch_items_pagination() but returns the summaries of the items shown on the page (name, price...).
+        :rtype: List of Listing objects and a HTML marker.
+        """
+        if page_id is None:
+            page_id = self.first_page_id
+        url = self._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max, sort=sort)
+        response = _get(url, self.session, self.rate_limiter, metrics=self.metrics)
+        return self._parse_search(response.content, response.headers.get('Content-Type'), listings=True)
+
+    def fetch_new_items(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: int = 1000
+    ) -> List[str]:  # list of URLs.
+        """
+        Items listed since the previous call with the same high water mark. The results are sorted by newest and
+        fetched until an item of the high water mark is found: usually one page per call, but the items are not
+        missed if more than a page of new items was listed in the meantime.
+        The first call (empty high water mark) only returns the first page.
+        :param keyword: Keyword for the search (required).
+        :param high_water_mark: Newest items seen by this query. Updated in place.
+        :param price_min: Minimum price in yen (optional).
+        :param price_max: Maximum price in yen (optional).
+        :param max_items_to_fetch: Maximum number of new items to return (optional).
+        :rtype: A list of URL (Strings), newest first.
+        """
+        return self._fetch_new(keyword, high_water_mark, price_min, price_max, max_items_to_fetch)
+
+    def fetch_new_listings(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: int = 1000
+    ) -> List[Listing]:
+        """
+        Same as fetch_new_items() but returns the summaries of the new items, so that they can be filtered
+        (e.g. by price) before fetching their pages.
+        :rtype: A list of Listing objects, newest first.
+        """
+        return self._fetch_new(keyword, high_water_mark, price_min, price_max, max_items_to_fetch, listings=True)
+
+    def _fetch_new(
+            self,
+            keyword: str,
+            high_water_mark: HighWaterMark,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            max_items_to_fetch: int,
+            listings: bool = False
+    ) -> list:
+        # see fetch_new_items().
+        new_items = []
+        seen = set()
+        pages = self._iter_pages(keyword, price_min, price_max, prefetch=1, sort=SORT_NEWEST, listings=listings)
+        try:
+            for items, _ in pages:
+                for item in items:
+                    item_id = self._listing_id(item)
+                    if item_id in high_water_mark:
+                        break
+                    if len(new_items) >= max_items_to_fetch:
+                        logger.warning(f'[{keyword}] More than {max_items_to_fetch} new items, some are skipped.')
+                        break
+                    # the items can move to the next page while we paginate.
+                    if item_id not in seen:
+                        seen.add(item_id)
+                        new_items.append(item)
+                else:
+                    if len(high_water_mark) > 0:
+                        continue
+                break
+        finally:
+            pages.close()
+        # only updated once all the new items are fetched.
+        high_water_mark.update([self._listing_id(item) for item in new_items])
+        return new_items
+
+    def price_bands(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> List[PriceBand]:
+        """
+        Split a price range into bands whose results can be fetched completely, i.e. that fit in max_search_pages
+        pages. A band is split in two while its first page reports more results than that (or, if the page does not
+        report the number of results, while its last page that can be fetched is not empty).
+        :param keyword: Keyword for the search (required).
+        :param price_min: Minimum price in yen (optional). Defaults to 0.
+        :param price_max: Maximum price in yen (optional). Defaults to MAX_PRICE.
+        :param max_workers: Number of bands probed concurrently.
+        :rtype: Sorted list of (price_min, price_max) bands, bounds included.
+        """
+        page_limiter = self._sharding_limiter(max_workers)
+        bands = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probes = {}
+            for band in _split_band(price_min, price_max, False):
+                probes[executor.submit(self._probe_band, keyword, band, False, page_limiter)] = band
+            try:
+                while len(probes) > 0:
+                    done, _ = wait(probes, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        band = probes.pop(future)
+                        _, too_large = future.result()
+                        sub_bands = _split_band(*band, too_large)
+                        if len(sub_bands) == 1:
+                            bands.append(band)
+                            continue
+                        for sub_band in sub_bands:
+                            probes[executor.submit(self._probe_band, keyword, sub_band, False, page_limiter)] = sub_band
+            finally:
+                for future in probes:
+                    future.cancel()
+        return sorted(bands)
+
+    def iter_items_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> Iterator[str]:  # URLs.
+        """
+        All the results of a search, beyond the pagination limit of the marketplace: the price range is split
+        into bands (see price_bands()) and the bands are crawled concurrently as soon as they are found.
+        The items are yielded once (deduplicated by item ID), band after band, in no particular order.
+        :param keyword: Keyword for the search (required).
+        :param price_min: Minimum price in yen (optional). Defaults to 0.
+        :param price_max: Maximum price in yen (optional). Defaults to MAX_PRICE.
+        :param max_items_to_fetch: Maximum number of items to return (optional).
+        :param max_workers: Number of bands fetched concurrently. Requests are paced by the rate limiter of the
+        backend, or at PAGINATION_RATE pages per second and per worker if there is none.
+        :rtype: Iterator of URL (Strings).
+        """
+        return self._iter_sharded(keyword, price_min, price_max, max_items_to_fetch, max_workers, listings=False)
+
+    def iter_listings_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int] = None,
+            price_max: Union[None, int] = None,
+            max_items_to_fetch: Union[None, int] = None,
+            max_workers: int = 4
+    ) -> Iterator[Listing]:
+        """
+        Same as iter_items_sharded() but yields the summaries of the items shown on the search pages.
+        :rtype: Iterator of Listing objects.
+        """
+        return self._iter_sharded(keyword, price_min, price_max, max_items_to_fetch, max_workers, listings=True)
+
+    def _iter_sharded(
+            self,
+            keyword: str,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            max_items_to_fetch: Union[None, int],
+            max_workers: int,
+            listings: bool
+    ) -> Iterator[Union[str, Listing]]:
+        # same loop as price_bands() but each band is crawled as soon as it is small enough.
+        page_limiter = self._sharding_limiter(max_workers)
+        stop = threading.Event()
+        seen = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probes, crawls = {}, set()
+            for band in _split_band(price_min, price_max, False):
+                probes[executor.submit(self._probe_band, keyword, band, listings, page_limiter)] = band
+            try:
+                while len(probes) + len(crawls) > 0:
+                    done, _ = wait(set(probes) | crawls, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in crawls:
+                            crawls.remove(future)
+                            for item in future.result():
+                                item_id = self._listing_id(item)
+                                if item_id in seen:
+                                    continue  # the price changed during the crawl.
+                                if max_items_to_fetch is not None and len(seen) >= max_items_to_fetch:
+                                    return
+                                seen.add(item_id)
+                                yield item
+                            continue
+                        band = probes.pop(future)
+                        first_page, too_large = future.result()
+                        sub_bands = _split_band(*band, too_large)
+                        if len(sub_bands) == 1:
+                            crawls.add(executor.submit(
+                                self._crawl_band, keyword, band, first_page, listings, page_limiter, stop))
+                            continue
+                        for sub_band in sub_bands:
+                            probes[executor.submit(self._probe_band, keyword, sub_band, listings, page_limiter)] = \
+                                sub_band
+            finally:
+                stop.set()
+                for future in list(probes) + list(crawls):
+                    future.cancel()
+        logger.debug(f'[{keyword}] {len(seen)} items found.')
+
+    def _sharding_limiter(self, max_workers: int) -> Union[None, TokenBucket]:
+        # one pace for all the workers of a sharded search if the backend has no rate limiter.
+        return TokenBucket(PAGINATION_RATE * max_workers) if self.rate_limiter is None else None
+
+    def _probe_band(
+            self,
+            keyword: str,
+            band: PriceBand,
+            listings: bool,
+            page_limiter: Union[None, TokenBucket]
+    ) -> Tuple[Tuple[list, Any], bool]:
+        # returns the first page of the band and whether the band has more results than max_search_pages pages.
+        fetch_pagination = self.fetch_listings_pagination if listings else self.fetch_items_pagination
+        if page_limiter is not None:
+            page_limiter.acquire()
+        items, marker = fetch_pagination(keyword, self.first_page_id, *band)
+        if self._is_last_page(items, marker):
+            return (items, marker), False
+        num_results = self._count_results(items, marker)
+        if num_results is not None:
+            return (items, marker), num_results > len(items) * self.max_search_pages
+        if page_limiter is not None:
+            page_limiter.acquire()
+        # the results beyond the deepest page are cut: a band that reaches it may have more.
+        last_page_id = self.first_page_id + self.max_search_pages - 1
+        deepest_items, deepest_marker = fetch_pagination(keyword, last_page_id, *band)
+        return (items, marker), not self._is_last_page(deepest_items, deepest_marker)
+
+    def _crawl_band(
+            self,
+            keyword: str,
+            band: PriceBand,
+            first_page: Tuple[list, Any],
+            listings: bool,
+            page_limiter: Union[None, TokenBucket],
+            stop: threading.Event
+    ) -> list:
+        # the first page was fetched by _probe_band().
+        items, marker = first_page
+        if self._is_last_page(items, marker):
+            return items
+        items = list(items)
+        pages = self._iter_pages(keyword, *band, listings=listings, page_id=self.first_page_id + 1,
+                                 page_limiter=page_limiter)
+        try:
+            for page_items, _ in pages:
+                if stop.is_set():
+                    break
+                items.extend(page_items)
+        finally:
+            pages.close()
+        logger.debug(f'[{keyword}] {len(items)} items between {band[0]} and {band[1]} yen.')
+        return items
 
     def get_item_info(
             self,
@@ -79,14 +563,184 @@ class Common:
         :param item_url: The URL of the item to fetch.
         :rtype: Item: The Item object.
         """
+        if self.item_cache is None:
+            response = _get(item_url, self.session, self.rate_limiter, metrics=self.metrics)
+            return self._parse_item(response.content, response.headers.get('Content-Type'), item_url)
+        item = self.item_cache.get(item_url)
+        result = 'hit'
+        if item is None:
+            validators = self.item_cache.validators(item_url)
+            response = _get(item_url, self.session, self.rate_limiter, validators, self.metrics)
+            if response.status_code == 304:
+                item = self.item_cache.revalidated(item_url)
+                result = 'revalidated'
+            if item is None:
+                result = 'miss'
+                if response.status_code != 200:  # 304 but the entry was evicted in the meantime.
+                    response = _get(item_url, self.session, self.rate_limiter, metrics=self.metrics)
+                item = self._parse_item(response.content, response.headers.get('Content-Type'), item_url)
+                self.item_cache.put(item_url, item, response.headers)
+        if self.metrics is not None:
+            self.metrics.increment('cache_requests_total', labels={'cache': 'item', 'result': result})
+        return self._attach(item)
+
+    def _parse_search(self, content: bytes, content_type: Union[None, str],
+                      listings: bool = False) -> Union[List[Union[str, Listing]], Any]:
+        with timed(self.metrics, 'parse_seconds', {'backend': self.name, 'page': 'search'}):
+            tree = _parse_html(content, content_type)
+            return self._parse_listings_page(tree) if listings else self._parse_items_page(tree)
+
+    def _parse_item(self, content: bytes, content_type: Union[None, str], item_url: str) -> Item:
+        with timed(self.metrics, 'parse_seconds', {'backend': self.name, 'page': 'item'}):
+            return self._parse_item_page(_parse_html(content, content_type), item_url)
+
+    def _attach(self, item: Item) -> Item:
+        # items restored from a persistent cache download their photos with this backend.
+        if item._session is None:
+            item._session = self._session
+            item._photo_cache = self.photo_cache
+        return item
+
+    def get_item_infos(
+            self,
+            item_urls: List[str],
+            max_workers: int = 8,
+            rate_limit: Union[None, float] = None
+    ) -> List[Union[Item, Exception]]:
+        """
+        Fetch many items concurrently. A failure does not abort the batch: the exception is returned instead.
+        :param item_urls: The URLs of the items to fetch.
+        :param max_workers: Maximum number of simultaneous requests.
+        :param rate_limit: Maximum number of requests per second per marketplace for this batch (optional).
+        :rtype: List of Item objects (or exceptions), in the same order as item_urls.
+        """
+        results = dict(self.iter_item_infos(item_urls, max_workers, rate_limit))
+        return [results[item_url] for item_url in item_urls]
+
+    def iter_item_infos(
+            self,
+            item_urls: List[str],
+            max_workers: int = 8,
+            rate_limit: Union[None, float] = None
+    ) -> Iterator[Tuple[str, Union[Item, Exception]]]:
+        """
+        Same as get_item_infos() but the items are yielded as soon as they are fetched.
+        :rtype: Iterator of (URL, Item object or exception).
+        """
+        batch_limiter = RateLimiter(rate_limit) if rate_limit is not None else None
+
+        def fetch_item(item_url: str) -> Item:
+            if batch_limiter is not None:
+                batch_limiter.acquire(item_url)
+            return self.get_item_info(item_url)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_item, item_url): item_url for item_url in set(item_urls)}
+            try:
+                for future in as_completed(futures):
+                    item_url = futures[future]
+                    try:
+                        yield item_url, future.result()
+                    except Exception as e:
+                        logger.warning(f'Could not fetch {item_url}: {e!r}.')
+                        yield item_url, e
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def item_id(self, item_url: str) -> str:
+        """
+        :param item_url: The URL of the item.
+        :rtype: ID of the item on its marketplace (e.g. m53585037017).
+        """
+        return urlparse(item_url).path.rstrip('/').split('/')[-1]
+
+    def _listing_id(self, item: Union[str, Listing]) -> str:
+        return item.item_id if isinstance(item, Listing) else self.item_id(item)
+
+    def _iter_pages(
+            self,
+            keyword: str,
+            price_min: Union[None, int],
+            price_max: Union[None, int],
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE,
+            listings: bool = False,
+            page_id: Union[None, int] = None,
+            page_limiter: Union[None, TokenBucket] = None
+    ) -> Iterator[Tuple[List[Union[str, Listing]], Any]]:
+        # yields the pages in order (from page_id) while the next ones are fetched in the background.
+        # the pages still in flight are cancelled when the generator is closed.
+        if page_limiter is None and self.rate_limiter is None:
+            page_limiter = TokenBucket(PAGINATION_RATE)
+        fetch_pagination = self.fetch_listings_pagination if listings else self.fetch_items_pagination
+
+        def fetch_page(page_id: int):
+            if page_limiter is not None:
+                page_limiter.acquire()
+            return fetch_pagination(keyword, page_id, price_min, price_max, sort)
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque()
+            next_page_id = self.first_page_id if page_id is None else page_id
+            try:
+                while True:
+                    while len(pending) < prefetch:
+                        pending.append(executor.submit(fetch_page, next_page_id))
+                        next_page_id += 1
+                    items, marker = pending.popleft().result()
+                    yield items, marker
+                    if self._is_last_page(items, marker):
+                        return
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _parse_items_page(self, tree: html.HtmlElement) -> Union[List[str], Any]:
+        """
+        :param tree: Parsed search page.
+        :rtype: List of URLS and a HTML marker.
+        """
+        pass
+
+    def _parse_listings_page(self, tree: html.HtmlElement) -> Union[List[Listing], Any]:
+        """
+        :param tree: Parsed search page.
+        :rtype: List of Listing objects and a HTML marker (the same as _parse_items_page()).
+        """
+        pass
+
+    def _parse_item_page(self, tree: html.HtmlElement, item_url: str) -> Item:
+        """
+        :param tree: Parsed item page.
+        :param item_url: The URL of the item.
+        :rtype: Item: The Item object.
+        """
         pass
 
+    def _count_results(self, items: List[Union[str, Listing]], marker: Any) -> Union[None, int]:
+        """
+        :param items: URLs (or listings) found on the first page.
+        :param marker: HTML marker returned by _parse_items_page().
+        :rtype: Total number of results of the search, or None if the page does not report it.
+        """
+        return None
+
+    def _is_last_page(self, items: List[Union[str, Listing]], marker: Any) -> bool:
+        """
+        :param items: URLs (or listings) found on the page.
+        :param marker: HTML marker returned by _parse_items_page().
+        :rtype: True if there are no more pages to fetch.
+        """
+        return len(items) == 0
+
     def _fetch_url(
             self,
             page: int,
             keyword: str,
             price_min: Union[None, int],
-            price_max: Union[None, int]
+            price_max: Union[None, int],
+            sort: str = SORT_RELEVANCE
     ) -> str:
         # https://fril.jp/s?max=30000&min=10000&order=desc&page=2&query=clothes&sort=relevance
         # https://www.mercari.com/jp/search/?page=200&keyword=%E9%9F%BF%EF%BC%91%EF%BC%97&sort_order=&price_max=10000
@@ -97,28 +751,95 @@ class Common:
         return 'common'
 
 
-def _get_soup(url: str) -> BeautifulSoup:
+def _limit(pages: Iterator[Tuple[list, Any]], max_items_to_fetch: Union[None, int]) -> Iterator:
+    # flattens the pages and stops exactly at max_items_to_fetch.
+    count = 0
+    try:
+        for items, _ in pages:
+            for item in items:
+                if max_items_to_fetch is not None and count >= max_items_to_fetch:
+                    logger.debug(f'Reached the maximum items to fetch: {max_items_to_fetch}.')
+                    return
+                count += 1
+                yield item
+            logger.debug(f'Found {count} items so far.')
+        logger.debug('No more items to fetch.')
+    finally:
+        pages.close()
+
+
+def _split_band(price_min: Union[None, int], price_max: Union[None, int], too_large: bool) -> List[PriceBand]:
+    # halves of the band if it is too large (and more than one price), else the band itself.
+    price_min = 0 if price_min is None else price_min
+    price_max = MAX_PRICE if price_max is None else price_max
+    if not too_large:
+        return [(price_min, price_max)]
+    if price_min >= price_max:
+        logger.warning(f'Too many results at {price_min} yen: some of them are not fetched.')
+        return [(price_min, price_max)]
+    middle = (price_min + price_max) // 2
+    return [(price_min, middle), (middle + 1, price_max)]
+
+
+def _get(url: str,
+         session: Union[None, requests.Session] = None,
+         rate_limiter: Union[None, RateLimiter] = None,
+         headers: Union[None, Dict[str, str]] = None,
+         metrics: Union[None, Metrics] = None) -> requests.Response:
+    # conditional requests (headers) can also be answered by 304 Not Modified.
+    if rate_limiter is not None:
+        with timed(metrics, 'rate_limit_wait_seconds', {'host': urlparse(url).netloc}):
+            rate_limiter.acquire(url)
     logger.info(f'GET: {url}')
-    headers = {'User-Agent': "'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 "
-                             "(KHTML, like Gecko) Chrome/29.0.1547.62 Safari/537.36'"}
-    response = requests.get(url, headers=headers, timeout=20)
-    if response.status_code != 200:
+    headers = headers or {}
+    start = time.perf_counter()
+    if session is None:
+        response = requests.get(url, headers={**DEFAULT_HEADERS, **headers}, timeout=DEFAULT_TIMEOUT)
+    else:
+        response = session.get(url, headers=headers, timeout=DEFAULT_TIMEOUT)
+    if metrics is not None:
+        _record_response(metrics, url, response, time.perf_counter() - start)
+    if response.status_code != 200 and not (response.status_code == 304 and headers):
         logger.error(response)
         raise ConnectionError()
-    soup = BeautifulSoup(response.content, 'lxml')
-    return soup
+    return response
 
 
-def _download_photo(url_photo: str, temp_dir: Union[None, str] = None):
-    if temp_dir is None:
-        temp_dir = Path(tempfile.gettempdir()) / 'photos'
-    else:
-        temp_dir = Path(temp_dir)
-    if not temp_dir.exists():
-        temp_dir.mkdir(parents=True, exist_ok=True)
-
-    logger.debug(f'Selected tmp folder: {temp_dir}.')
-    remote_filename = Path(urlparse(url_photo).path).name
-    wget.download(url=url_photo, out=str(temp_dir), bar=None)
-    local_url = str(temp_dir / remote_filename)
-    return local_url
+def _record_response(metrics: Metrics, url: str, response: requests.Response, duration: float):
+    # elapsed stops when the headers are parsed (after the connection and the retries). The rest is the download.
+    ttfb = response.elapsed.total_seconds()
+    retries = getattr(response.raw, 'retries', None)
+    metrics.record_request(urlparse(url).netloc, response.status_code, len(response.content),
+                           ttfb, max(0.0, duration - ttfb), len(retries.history) if retries is not None else 0)
+
+
+def _parse_html(content: bytes, content_type: Union[None, str] = None) -> html.HtmlElement:
+    # both websites are served in UTF-8, unless the headers say otherwise.
+    encoding = 'utf-8'
+    if content_type is not None and 'charset=' in content_type:
+        encoding = content_type.split('charset=')[-1].split(';')[0].strip()
+    return html.document_fromstring(content, parser=html.HTMLParser(encoding=encoding))
+
+
+def _has_class(name: str) -> str:
+    # XPath predicate equivalent to the CSS selector .name
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+def download_photos(items: List[Item], max_workers: int = 8) -> List[str]:
+    """
+    Download the photos of many items concurrently. Items that already have a local photo are skipped.
+    :param items: List of Item objects.
+    :param max_workers: Maximum number of simultaneous downloads.
+    :rtype: List of local paths, in the same order as items.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda item: item.local_url, items))
+
+
+def _download_photo(url_photo: str,
+                    session: Union[None, requests.Session] = None,
+                    photo_cache: Union[None, PhotoCache] = None) -> str:
+    if photo_cache is None:
+        photo_cache = default_photo_cache()
+    return photo_cache.fetch(url_photo, session)
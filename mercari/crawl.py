@@ -0,0 +1,229 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import List, Union, IO, Callable, NamedTuple, Iterable, Tuple, Dict
+
+import requests
+
+from mercari.common import Item
+from mercari.mercari import Mercari
+from mercari.rakuma import Rakuma
+from mercari.rate_limit import RateLimiter, TokenBucket, MARKETPLACE_HOSTS
+from mercari.session import build_session
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {'mercari': Mercari, 'rakuma': Rakuma}
+
+
+class WorkUnit(NamedTuple):
+    marketplace: str  # mercari or rakuma.
+    keyword: str
+    price_min: Union[None, int] = None
+    price_max: Union[None, int] = None
+
+
+def work_units(keywords: Iterable[str],
+               marketplaces: Iterable[str] = tuple(BACKENDS),
+               price_bands: Iterable[Tuple[Union[None, int], Union[None, int]]] = ((None, None),)) -> List[WorkUnit]:
+    """
+    :param keywords: Keywords to crawl.
+    :param marketplaces: Names of the backends to crawl.
+    :param price_bands: (price_min, price_max) of each unit, see split_prices().
+    :rtype: One work unit per marketplace, keyword and price band.
+    """
+    price_bands = list(price_bands)
+    return [WorkUnit(marketplace, keyword, price_min, price_max)
+            for marketplace in marketplaces for keyword in keywords for price_min, price_max in price_bands]
+
+
+def split_prices(price_min: int, price_max: int, num_bands: int) -> List[Tuple[int, int]]:
+    """
+    :param price_min: Minimum price in yen.
+    :param price_max: Maximum price in yen.
+    :param num_bands: Number of bands.
+    :rtype: num_bands contiguous (price_min, price_max) ranges of the same width.
+    """
+    bounds = [price_min + (price_max - price_min + 1) * i // num_bands for i in range(num_bands + 1)]
+    return [(low, high - 1) for low, high in zip(bounds, bounds[1:]) if high > low]
+
+
+class SharedTokenBucket(TokenBucket):
+
+    def __init__(self, rate: float, burst: int = 1, context=multiprocessing):
+        """
+        Same as TokenBucket but shared by several processes (the state lives in shared memory).
+        Must be given to the processes when they are created.
+        :param rate: Number of tokens added per second.
+        :param burst: Maximum number of tokens that can be accumulated.
+        :param context: multiprocessing context of the processes.
+        """
+        # no call to TokenBucket.__init__(): its threading.Lock cannot be shared.
+        self.rate = rate
+        self.burst = burst
+        self._lock = context.Lock()
+        self._state = context.RawArray('d', [float(burst), time.monotonic()])  # tokens, last refill.
+
+    def _reserve(self) -> float:
+        # see TokenBucket._reserve(). time.monotonic() is the same clock in all the processes.
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate) - 1
+            self._state[0], self._state[1] = tokens, now
+            if tokens >= 0:
+                return 0.0
+            return -tokens / self.rate
+
+
+class SharedRateLimiter(RateLimiter):
+
+    def __init__(self,
+                 rate: float,
+                 burst: int = 1,
+                 hosts: Union[None, Dict[str, str]] = None,
+                 context=multiprocessing):
+        """
+        Same as RateLimiter but the budget is shared by several processes.
+        The buckets are created upfront: one per marketplace of hosts, and one shared by all the other hosts.
+        :param rate: Maximum number of requests per second to the same marketplace, for all the processes.
+        :param burst: Maximum burst of requests to the same marketplace.
+        :param hosts: Name of the bucket of each host (optional). Defaults to MARKETPLACE_HOSTS.
+        :param context: multiprocessing context of the processes.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.hosts = MARKETPLACE_HOSTS if hosts is None else hosts
+        self._buckets = {key: SharedTokenBucket(rate, burst, context) for key in set(self.hosts.values())}
+        self._default_bucket = SharedTokenBucket(rate, burst, context)
+
+    def bucket(self, url: str) -> TokenBucket:
+        return self._buckets.get(self.key(url), self._default_bucket)
+
+
+def bulk_crawl(units: List[WorkUnit],
+               output: Union[str, IO[str]],
+               processes: Union[None, int] = None,
+               threads: int = 4,
+               rate: float = 1.0,
+               burst: int = 1,
+               max_items_per_unit: Union[None, int] = None,
+               session_factory: Callable[[], requests.Session] = build_session) -> Dict[str, float]:
+    """
+    Crawl many (marketplace, keyword, price band) units with a pool of processes, so that the HTML parsing is not
+    limited by the GIL. Each process has its own session and fetches the item pages of its units with a few
+    threads. The rate limit is global: shared by all the processes. The items are written to output as soon as
+    they are fetched, in the format of items_to_jsonl(). An item found by several units is written once.
+    :param units: The work units, see work_units().
+    :param output: Path (or opened text file) of the JSONL output.
+    :param processes: Number of processes (optional). Defaults to the number of CPUs.
+    :param threads: Number of item pages fetched at the same time by each process.
+    :param rate: Maximum number of requests per second to the same marketplace, for all the processes.
+    :param burst: Maximum burst of requests to the same marketplace.
+    :param max_items_per_unit: Maximum number of items of each unit (optional).
+    :param session_factory: Builds the session of each process. Must be picklable (e.g. a module-level function).
+    :rtype: Statistics of the crawl: units, items, duplicates, errors and duration (in seconds).
+    """
+    if isinstance(output, str):
+        with open(output, 'w', encoding='utf8') as w:
+            return bulk_crawl(units, w, processes, threads, rate, burst, max_items_per_unit, session_factory)
+    processes = processes or os.cpu_count() or 1
+    # spawn: the workers do not inherit the threads and the sockets of the parent.
+    context = multiprocessing.get_context('spawn')
+    rate_limiter = SharedRateLimiter(rate, burst, context=context)
+    tasks, results = context.Queue(), context.Queue(maxsize=1000)
+    for unit in units:
+        tasks.put(unit)
+    for _ in range(processes):
+        tasks.put(None)
+    workers = [context.Process(target=_crawl_worker,
+                               args=(tasks, results, rate_limiter, threads, max_items_per_unit, session_factory),
+                               daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    stats = {'units': 0, 'items': 0, 'duplicates': 0, 'errors': 0}
+    seen = set()
+    start = time.monotonic()
+    running = len(workers)
+    try:
+        while running > 0:
+            try:
+                kind, payload = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    logger.error('All the crawl workers exited unexpectedly.')
+                    break
+                continue
+            if kind == 'items':
+                for d in payload:
+                    if d['url'] in seen:
+                        stats['duplicates'] += 1
+                        continue
+                    seen.add(d['url'])
+                    output.write(json.dumps(d, ensure_ascii=False) + '\n')
+                    stats['items'] += 1
+            elif kind == 'unit':
+                stats['units'] += 1
+                logger.info(f'{payload} done ({stats["units"]}/{len(units)} units, {stats["items"]} items).')
+            elif kind == 'error':
+                stats['errors'] += 1
+            elif kind == 'done':
+                running -= 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+    stats['duration'] = time.monotonic() - start
+    return stats
+
+
+def _crawl_worker(tasks: multiprocessing.Queue,
+                  results: multiprocessing.Queue,
+                  rate_limiter: SharedRateLimiter,
+                  threads: int,
+                  max_items_per_unit: Union[None, int],
+                  session_factory: Callable[[], requests.Session],
+                  batch_size: int = 50):
+    # one backend (session and parser) per marketplace and per process.
+    backends = {name: backend_cls(session=session_factory(), rate_limiter=rate_limiter)
+                for name, backend_cls in BACKENDS.items()}
+    fetched = set()
+    try:
+        while True:
+            unit = tasks.get()
+            if unit is None:
+                break
+            backend = backends[unit.marketplace]
+            try:
+                item_urls = backend.iter_items(unit.keyword, unit.price_min, unit.price_max, max_items_per_unit)
+                batch = []
+                for item_url in item_urls:
+                    if item_url not in fetched:
+                        fetched.add(item_url)
+                        batch.append(item_url)
+                    if len(batch) >= batch_size:
+                        _fetch_items(backend, batch, threads, results)
+                        batch = []
+                _fetch_items(backend, batch, threads, results)
+            except Exception as e:
+                logger.exception(f'{unit} failed.')
+                results.put(('error', repr(e)))
+            results.put(('unit', unit))
+    finally:
+        results.put(('done', None))
+
+
+def _fetch_items(backend, item_urls: List[str], threads: int, results: multiprocessing.Queue):
+    items = []
+    for item_url, item in backend.iter_item_infos(item_urls, max_workers=threads):
+        if isinstance(item, Item):
+            items.append(item.to_dict())
+        else:
+            results.put(('error', repr(item)))
+    if items:
+        results.put(('items', items))
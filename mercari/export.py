@@ -0,0 +1,121 @@
+import json
+from operator import attrgetter
+from typing import List, Iterator, Union, IO, Dict
+
+from mercari.common import Item
+
+# Column types of the columnar exports (see Item.fields).
+_NUMPY_TYPES = {'price': 'i8', 'sold_out': '?'}
+
+
+def items_to_jsonl(items: List[Item], f: Union[str, IO[str]]):
+    """
+    :param items: List of Item objects.
+    :param f: Path (or opened text file) where to write one JSON object per line.
+    """
+    if isinstance(f, str):
+        with open(f, 'w', encoding='utf8') as w:
+            return items_to_jsonl(items, w)
+    f.writelines(json.dumps(item.to_dict(), ensure_ascii=False) + '\n' for item in items)
+
+
+def items_from_jsonl(f: Union[str, IO[str]]) -> Iterator[Item]:
+    """
+    :param f: Path (or opened text file) written by items_to_jsonl().
+    :rtype: Iterator of Item objects.
+    """
+    if isinstance(f, str):
+        with open(f, 'r', encoding='utf8') as r:
+            yield from items_from_jsonl(r)
+        return
+    for line in f:
+        if line.strip():
+            yield Item.from_dict(json.loads(line))
+
+
+def items_to_columns(items: List[Item]) -> Dict[str, list]:
+    """
+    :param items: List of Item objects.
+    :rtype: One list per field of Item.fields.
+    """
+    return {field: list(map(attrgetter(_attr(field)), items)) for field in Item.fields}
+
+
+def items_from_columns(columns: Dict[str, list]) -> List[Item]:
+    """
+    :param columns: One list per field, as returned by items_to_columns().
+    :rtype: List of Item objects.
+    """
+    names = [field for field in Item.fields if field in columns]
+    return [Item(**dict(zip(names, row))) for row in zip(*[columns[name] for name in names])]
+
+
+def items_to_numpy(items: List[Item]):
+    """
+    Requires numpy.
+    :param items: List of Item objects.
+    :rtype: numpy structured array with one record per item. Strings are stored as fixed-width unicode.
+    """
+    import numpy as np
+    columns = items_to_columns(items)
+    columns['local_url'] = [u or '' for u in columns['local_url']]
+    dtype = [(field, _NUMPY_TYPES[field] if field in _NUMPY_TYPES else f'U{max(map(len, columns[field]), default=1)}')
+             for field in Item.fields]
+    array = np.empty(len(items), dtype=dtype)
+    for field in Item.fields:
+        array[field] = columns[field]
+    return array
+
+
+def items_from_numpy(array) -> List[Item]:
+    """
+    :param array: numpy structured array returned by items_to_numpy().
+    :rtype: List of Item objects.
+    """
+    columns = {field: array[field].tolist() for field in array.dtype.names}
+    columns['local_url'] = [u or None for u in columns['local_url']]
+    return items_from_columns(columns)
+
+
+def items_to_arrow(items: List[Item]):
+    """
+    Requires pyarrow.
+    :param items: List of Item objects.
+    :rtype: pyarrow.Table with one row per item.
+    """
+    import pyarrow as pa
+    columns = items_to_columns(items)
+    columns['marketplace'] = pa.array(columns['marketplace']).dictionary_encode()
+    return pa.table(columns)
+
+
+def items_from_arrow(table) -> List[Item]:
+    """
+    :param table: pyarrow.Table returned by items_to_arrow() or read from a Parquet file.
+    :rtype: List of Item objects.
+    """
+    return items_from_columns(table.to_pydict())
+
+
+def items_to_parquet(items: List[Item], path: str):
+    """
+    Requires pyarrow.
+    :param items: List of Item objects.
+    :param path: Where to write the Parquet file.
+    """
+    import pyarrow.parquet as pq
+    pq.write_table(items_to_arrow(items), path)
+
+
+def items_from_parquet(path: str) -> List[Item]:
+    """
+    :param path: Parquet file written by items_to_parquet().
+    :rtype: List of Item objects.
+    """
+    import pyarrow.parquet as pq
+    return items_from_arrow(pq.read_table(path))
+
+
+def _attr(field: str) -> str:
+    # local_url is a property that downloads the photo.
+    return '_local_url' if field == 'local_url' else field
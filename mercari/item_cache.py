@@ -0,0 +1,153 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Union, Dict
+
+from mercari.common import Item
+
+logger = logging.getLogger(__name__)
+
+
+class ItemCache:
+
+    def __init__(self, ttl: float = 60):
+        """
+        Cache of the items returned by get_item_info(), keyed by URL. Safe to share between threads and backends.
+        Fresh entries are served without any network I/O. Stale entries are revalidated with ETag/Last-Modified.
+        :param ttl: Default number of seconds during which an item is served without revalidation.
+        """
+        self.ttl = ttl
+
+    def get(self, item_url: str) -> Union[None, Item]:
+        """
+        :param item_url: The URL of the item.
+        :rtype: The Item object if it is cached and fresh, None otherwise.
+        """
+        entry = self._load(item_url)
+        if entry is None or entry['expires_at'] < time.time():
+            return None
+        return entry['item']
+
+    def validators(self, item_url: str) -> Dict[str, str]:
+        """
+        :param item_url: The URL of the item.
+        :rtype: Headers for a conditional request on a stale entry (empty if the item is not cached).
+        """
+        entry = self._load(item_url)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidated(self, item_url: str, ttl: Union[None, float] = None) -> Union[None, Item]:
+        """
+        Mark a stale entry as fresh again (the server answered 304 Not Modified).
+        :param item_url: The URL of the item.
+        :param ttl: Number of seconds before the next revalidation (optional). Defaults to the ttl of the cache.
+        :rtype: The cached Item object (None if it was evicted in the meantime).
+        """
+        entry = self._load(item_url)
+        if entry is None:
+            return None
+        entry['expires_at'] = time.time() + (self.ttl if ttl is None else ttl)
+        self._store(item_url, entry)
+        return entry['item']
+
+    def put(self, item_url: str, item: Item, headers: Dict[str, str], ttl: Union[None, float] = None):
+        """
+        :param item_url: The URL of the item.
+        :param item: The Item object.
+        :param headers: Headers of the response (for ETag and Last-Modified).
+        :param ttl: Number of seconds during which this item is fresh (optional). Defaults to the ttl of the cache.
+        """
+        self._store(item_url, {
+            'item': item,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'expires_at': time.time() + (self.ttl if ttl is None else ttl)
+        })
+
+    def _load(self, item_url: str) -> Union[None, dict]:
+        """
+        :param item_url: The URL of the item.
+        :rtype: A copy of the entry (item, etag, last_modified and expires_at), or None if it is not cached.
+        """
+        pass
+
+    def _store(self, item_url: str, entry: dict):
+        """
+        :param item_url: The URL of the item.
+        :param entry: The entry (item, etag, last_modified and expires_at). Replaces the existing one (if any).
+        """
+        pass
+
+
+class MemoryItemCache(ItemCache):
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000):
+        """
+        In-memory cache. The least recently used items are evicted beyond max_size.
+        :param ttl: Default number of seconds during which an item is served without revalidation.
+        :param max_size: Maximum number of items.
+        """
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, item_url: str) -> Union[None, dict]:
+        with self._lock:
+            entry = self._entries.get(item_url)
+            if entry is None:
+                return None
+            self._entries.move_to_end(item_url)
+            return dict(entry)
+
+    def _store(self, item_url: str, entry: dict):
+        with self._lock:
+            self._entries[item_url] = entry
+            self._entries.move_to_end(item_url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SQLiteItemCache(ItemCache):
+
+    def __init__(self, filename: str, ttl: float = 60):
+        """
+        Persistent cache in a SQLite database. Can be shared between processes.
+        :param filename: Path to the database (created if it does not exist).
+        :param ttl: Default number of seconds during which an item is served without revalidation.
+        """
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS items (url TEXT PRIMARY KEY, item TEXT, etag TEXT, '
+                           'last_modified TEXT, expires_at REAL)')
+
+    def _load(self, item_url: str) -> Union[None, dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT item, etag, last_modified, expires_at FROM items WHERE url = ?',
+                                     (item_url,)).fetchone()
+        if row is None:
+            return None
+        item, etag, last_modified, expires_at = row
+        return {'item': Item.from_dict(json.loads(item)), 'etag': etag,
+                'last_modified': last_modified, 'expires_at': expires_at}
+
+    def _store(self, item_url: str, entry: dict):
+        row = (item_url, json.dumps(entry['item'].to_dict()), entry['etag'], entry['last_modified'], entry['expires_at'])
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)', row)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
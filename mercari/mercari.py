@@ -1,15 +1,23 @@
 import logging
 import re
-from time import sleep
 from typing import List, Any, Union
 
-# noinspection PyProtectedMember
-from bs4 import NavigableString
+from lxml import html
 
-from mercari.common import Item, Common, _get_soup
+# noinspection PyProtectedMember
+from mercari.common import Item, Listing, Common, _has_class
+from mercari.common import SORT_RELEVANCE, SORT_NEWEST, SORT_PRICE_ASC, SORT_PRICE_DESC
 
 logger = logging.getLogger(__name__)
 
+# Values of the sort_order parameter.
+SORT_ORDERS = {
+    SORT_RELEVANCE: '',
+    SORT_NEWEST: 'created_desc',
+    SORT_PRICE_ASC: 'price_asc',
+    SORT_PRICE_DESC: 'price_desc'
+}
+
 
 class Mercari(Common):
 
@@ -18,77 +26,97 @@ class Mercari(Common):
             keyword: str = 'clothes',
             price_min: Union[None, int] = None,
             price_max: Union[None, int] = None,
-            max_items_to_fetch: Union[None, int] = 100
+            max_items_to_fetch: Union[None, int] = 100,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
     ) -> List[str]:  # list of URLs.
-        items_list = []
-        for page_id in range(int(1e9)):
-            items, search_res_head_tag = self.fetch_items_pagination(keyword, page_id, price_min, price_max)
-            items_list.extend(items)
-            logger.debug(f'Found {len(items_list)} items so far.')
-
-            if max_items_to_fetch is not None and len(items_list) > max_items_to_fetch:
-                logger.debug(f'Reached the maximum items to fetch: {max_items_to_fetch}.')
-                break
-
-            if search_res_head_tag is None:
-                break
-            else:
-                search_res_head = str(search_res_head_tag.contents[0]).strip()
-                num_items = re.findall('\d+', search_res_head)
-                if len(num_items) == 1 and num_items[0] == '0':
-                    break
-            sleep(2)
-        logger.debug('No more items to fetch.')
-        return items_list
-
-    def fetch_items_pagination(
-            self,
-            keyword: str,
-            page_id: int = 0,
-            price_min: Union[None, int] = None,
-            price_max: Union[None, int] = None
-    ) -> Union[List[str], Any]:  # List of URLS and a HTML marker.
-        soup = _get_soup(self._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max))
-        search_res_head_tag = soup.find('h2', {'class': 'search-result-head'})
-        items = [s.find('a').attrs['href'] for s in soup.find_all('section', {'class': 'items-box'})]
-        items = [it if it.startswith('http') else 'https://www.mercari.com' + it for it in items]
-        return items, search_res_head_tag
+        # keeps the default keyword of the previous versions.
+        return super().fetch_all_items(keyword, price_min, price_max, max_items_to_fetch, prefetch, sort)
 
     def get_item_info(
             self,
             item_url: str = 'https://www.mercari.com/jp/items/m53585037017/'
     ) -> Item:
-        soup = _get_soup(item_url)
-        soup = soup.find('section', {'class': 'item-box-container'})
-        price = str(soup.find('span', {'class': 'item-price bold'}).contents[0]).replace('¥', '').replace(',', '')
-        name = str(soup.find('h1', {'class': 'item-name'}).contents[0])
+        # keeps the default item of the previous versions.
+        return super().get_item_info(item_url)
 
-        def filter_html_br(x):
-            return isinstance(x, NavigableString)
-
-        desc = list(filter(filter_html_br, soup.find('div', {'class': 'item-description f14'})))
-        desc = list(map(str, desc))
-        desc = ''.join(desc)
-
-        sold_out = soup.find('div', {'class': 'item-sold-out-badge'})
-        sold_out = sold_out is not None
-
-        photo = soup.find('div', {'class': 'item-photo'})
-        photo = photo.find('img').attrs['data-src']
+    def _parse_items_page(self, tree: html.HtmlElement) -> Union[List[str], Any]:  # List of URLS and a HTML marker.
+        search_res_head_tag = next(iter(tree.xpath(f'//h2[{_has_class("search-result-head")}]')), None)
+        items = [s.xpath('.//a')[0].get('href') for s in tree.xpath(f'//section[{_has_class("items-box")}]')]
+        items = [it if it.startswith('http') else 'https://www.mercari.com' + it for it in items]
+        return items, search_res_head_tag
 
-        item = Item(name=name, price=price, desc=desc, sold_out=sold_out, url_photo=photo, url=item_url)
+    def _parse_listings_page(self, tree: html.HtmlElement) -> Union[List[Listing], Any]:
+        search_res_head_tag = next(iter(tree.xpath(f'//h2[{_has_class("search-result-head")}]')), None)
+        listings = []
+        for section in tree.xpath(f'//section[{_has_class("items-box")}]'):
+            # one pass over the elements of the box: much faster than one XPath query per field.
+            url, name, price, sold_out, url_thumbnail = None, '', '0', False, None
+            for element in section.iter('a', 'img', 'h3', 'div'):
+                classes = (element.get('class') or '').split()
+                if element.tag == 'a' and url is None:
+                    url = element.get('href')
+                elif element.tag == 'img' and url_thumbnail is None:
+                    url_thumbnail = element.get('data-src')
+                elif 'items-box-name' in classes:
+                    name = str(element.text)
+                elif 'items-box-price' in classes:
+                    price = re.sub(r'[^\d]', '', element.text or '') or '0'
+                elif 'item-sold-out-badge' in classes:
+                    sold_out = True
+            url = url if url.startswith('http') else 'https://www.mercari.com' + url
+            listings.append(Listing(item_id=self.item_id(url), url=url, name=name, price=price, sold_out=sold_out,
+                                    url_thumbnail=url_thumbnail, marketplace=self.name))
+        return listings, search_res_head_tag
+
+    def _parse_item_page(self, tree: html.HtmlElement, item_url: str) -> Item:
+        tree = tree.xpath(f'//section[{_has_class("item-box-container")}]')[0]
+        price = tree.xpath(f'.//span[{_has_class("item-price")} and {_has_class("bold")}]')[0].text
+        price = price.replace('¥', '').replace(',', '')
+        name = str(tree.xpath(f'.//h1[{_has_class("item-name")}]')[0].text)
+
+        # text directly under the description (i.e. without the <br> tags).
+        desc = tree.xpath(f'.//div[{_has_class("item-description")} and {_has_class("f14")}]')[0]
+        desc = ''.join(map(str, desc.xpath('text()')))
+
+        sold_out = len(tree.xpath(f'.//div[{_has_class("item-sold-out-badge")}]')) > 0
+
+        photo = tree.xpath(f'.//div[{_has_class("item-photo")}]')[0]
+        photo = photo.xpath('.//img')[0].get('data-src')
+
+        item = Item(name=name, price=price, desc=desc, sold_out=sold_out, url_photo=photo, url=item_url,
+                    session=self._session, photo_cache=self.photo_cache, marketplace=self.name)
         return item
 
+    def _count_results(self, items: List[str], search_res_head_tag: Any) -> Union[None, int]:
+        if search_res_head_tag is None:
+            return None
+        # e.g. "CHANEL の検索結果 12,345件中 1-132件". The range of the page is not a count.
+        search_res_head = (search_res_head_tag.text or '').split('検索結果')[-1]
+        search_res_head = re.sub(r'\d[\d,]*\s*-\s*\d[\d,]*', '', search_res_head)
+        num_results = re.findall(r'\d[\d,]*', search_res_head)
+        if len(num_results) != 1:
+            return None
+        return int(num_results[0].replace(',', ''))
+
+    def _is_last_page(self, items: List[str], search_res_head_tag: Any) -> bool:
+        if search_res_head_tag is None:
+            return True
+        search_res_head = (search_res_head_tag.text or '').strip()
+        num_items = re.findall(r'\d+', search_res_head)
+        return len(num_items) == 1 and num_items[0] == '0'
+
     def _fetch_url(
             self,
             page: int = 0,
             keyword: str = 'bicycle',
             price_min: Union[None, int] = None,
-            price_max: Union[None, int] = None
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
     ):
         url = f'https://www.mercari.com/jp/search/?page={page}'
         url += f'&keyword={keyword}'
-        url += '&sort_order='
+        url += f'&sort_order={SORT_ORDERS[sort]}'
         if price_max is not None:
             url += f'&price_max={price_max}'
         if price_min is not None:
@@ -0,0 +1,216 @@
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+from typing import Callable, Dict, Tuple, Union, List
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Union[None, Dict[str, str]]
+
+
+class Metrics:
+
+    def __init__(self, prefix: str = 'mercari', buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        """
+        Thread-safe counters, gauges and histograms, exported in the Prometheus text format.
+        Give the same object to the backends, the photo cache, the scheduler and the notification dispatcher.
+
+        Recorded by the backends (labels: host):
+        requests_total (and status), response_bytes_total, retries_total, rate_limit_wait_seconds,
+        ttfb_seconds (time to the response headers, including the connection), download_seconds,
+        dns_seconds, connect_seconds and connection_queue_seconds (async backends only).
+        parse_seconds (labels: backend, page) and cache_requests_total (labels: cache, result).
+        :param prefix: Prefix of the exported metric names.
+        :param buckets: Upper bounds of the histogram buckets.
+        """
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._hooks: List[Callable[[str, float, Dict[str, str]], None]] = []
+        self._types: Dict[str, str] = {}
+        self._values: Dict[Tuple[str, tuple], Union[float, list]] = {}
+
+    def add_hook(self, hook: Callable[[str, float, Dict[str, str]], None]):
+        """
+        :param hook: Called with the name, the value and the labels of every recorded value.
+        """
+        self._hooks.append(hook)
+
+    def increment(self, name: str, value: float = 1.0, labels: Labels = None):
+        """
+        :param name: Name of the counter, e.g. requests_total.
+        :param value: Increment.
+        :param labels: Labels of the counter (optional).
+        """
+        key = self._key('counter', name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+        self._call_hooks(name, value, labels)
+
+    def set(self, name: str, value: float, labels: Labels = None):
+        """
+        :param name: Name of the gauge, e.g. notification_queue_size.
+        :param value: Current value.
+        :param labels: Labels of the gauge (optional).
+        """
+        key = self._key('gauge', name, labels)
+        with self._lock:
+            self._values[key] = value
+        self._call_hooks(name, value, labels)
+
+    def observe(self, name: str, value: float, labels: Labels = None):
+        """
+        :param name: Name of the histogram, e.g. parse_seconds.
+        :param value: Observed value.
+        :param labels: Labels of the histogram (optional).
+        """
+        key = self._key('histogram', name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                # count per bucket (the last one is +Inf), count, sum, max.
+                histogram = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0, 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+            histogram[3] = max(histogram[3], value)
+        self._call_hooks(name, value, labels)
+
+    @contextmanager
+    def timer(self, name: str, labels: Labels = None):
+        """
+        Observe the duration of the block (even if it raises).
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, labels)
+
+    def record_request(self, host: str, status: int, num_bytes: int, ttfb: float, download: float, retries: int = 0):
+        """
+        :param host: Host of the request.
+        :param status: HTTP status code of the response.
+        :param num_bytes: Size of the body.
+        :param ttfb: Number of seconds until the headers of the response were received.
+        :param download: Number of seconds to read the body.
+        :param retries: Number of retries before this response.
+        """
+        labels = {'host': host}
+        self.increment('requests_total', labels={**labels, 'status': str(status)})
+        self.increment('response_bytes_total', num_bytes, labels)
+        self.observe('ttfb_seconds', ttfb, labels)
+        self.observe('download_seconds', download, labels)
+        if retries > 0:
+            self.increment('retries_total', retries, labels)
+
+    def stats(self) -> dict:
+        """
+        :rtype: All the values, e.g. {'requests_total': {'host=fril.jp,status=200': 12.0}}.
+        Histograms are summarized by their count, sum, mean and max.
+        """
+        stats = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._values.items()):
+                if self._types[name] == 'histogram':
+                    _, count, total, maximum = value
+                    value = {'count': count, 'sum': round(total, 6), 'mean': round(total / count, 6),
+                             'max': round(maximum, 6)}
+                stats.setdefault(name, {})[','.join(f'{k}={v}' for k, v in labels)] = value
+        return stats
+
+    def to_prometheus(self) -> str:
+        """
+        :rtype: All the values in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            values = sorted(self._values.items())
+            for name in sorted(self._types):
+                metric_name = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {metric_name} {self._types[name]}')
+                for (n, labels), value in values:
+                    if n != name:
+                        continue
+                    if self._types[name] != 'histogram':
+                        lines.append(f'{metric_name}{_format_labels(labels)} {value}')
+                        continue
+                    bucket_counts, count, total, _ = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                        cumulative += bucket_count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{metric_name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{metric_name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{metric_name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _key(self, metric_type: str, name: str, labels: Labels) -> Tuple[str, tuple]:
+        if self._types.setdefault(name, metric_type) != metric_type:
+            raise ValueError(f'{name} is a {self._types[name]}, not a {metric_type}.')
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def _call_hooks(self, name: str, value: float, labels: Labels):
+        for hook in self._hooks:
+            try:
+                hook(name, value, labels or {})
+            except Exception:
+                logger.exception(f'Metrics hook {hook} failed.')
+
+
+def timed(metrics: Union[None, Metrics], name: str, labels: Labels = None):
+    """
+    Same as Metrics.timer() but does nothing if metrics is None.
+    """
+    if metrics is None:
+        return _no_timer()
+    return metrics.timer(name, labels)
+
+
+@contextmanager
+def _no_timer():
+    yield
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def serve_metrics(metrics: Metrics, port: int, host: str = '') -> ThreadingHTTPServer:
+    """
+    Serve the metrics in the Prometheus text format on http://host:port/metrics, from a background thread.
+    :param metrics: The metrics to export.
+    :param port: Port to listen to.
+    :param host: Interface to listen to (optional). Defaults to all the interfaces.
+    :rtype: The HTTP server. Call shutdown() to stop it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving the metrics on port {server.server_address[1]}.')
+    return server
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union, Dict, Iterable
+from urllib.parse import urlparse
+
+import requests
+
+from mercari.metrics import Metrics
+from mercari.rate_limit import RateLimiter
+from mercari.session import DEFAULT_HEADERS, DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+
+    def __init__(self,
+                 directory: Union[None, str] = None,
+                 max_bytes: int = 512 * 1024 * 1024,
+                 max_age: float = 24 * 3600,
+                 metrics: Union[None, Metrics] = None):
+        """
+        On-disk photo cache keyed by a hash of the URL.
+        Fresh entries are served without any network I/O. Stale entries are revalidated with ETag/Last-Modified.
+        The least recently used photos are evicted when the cache grows beyond max_bytes. The sizes and the order
+        of use are kept in memory (read from the directory at start): only one process should write to it.
+        :param directory: Where to store the photos (optional). Defaults to a folder in the temp dir.
+        :param max_bytes: Maximum size of the cache on disk.
+        :param max_age: Number of seconds during which a photo is served without revalidation.
+        :param metrics: Where to record the cache hits and the downloads (optional).
+        """
+        if directory is None:
+            directory = Path(tempfile.gettempdir()) / 'photo_cache'
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        # size of each photo, least recently used first: the evictions never scan the directory.
+        files = sorted((p.stat().st_mtime, str(p), p.stat().st_size) for p in self._photo_files())
+        self._entries = OrderedDict((path, size) for _, path, size in files)
+        self._size = sum(self._entries.values())
+
+    def fetch(self,
+              url: str,
+              session: Union[None, requests.Session] = None,
+              rate_limiter: Union[None, RateLimiter] = None) -> str:
+        """
+        :param url: URL of the photo.
+        :param session: HTTP session used on a cache miss (optional).
+        :param rate_limiter: Paces the requests on a cache miss (optional). The hits are not limited.
+        :rtype: Local path to the photo.
+        """
+        local_url = self.get(url)
+        if local_url is not None:
+            self.record('hit')
+            return local_url
+        start = time.perf_counter()
+        response = _request(url, session, self.validators(url), rate_limiter)
+        if response.status_code == 304:
+            with response:
+                local_url = self.revalidated(url)
+            if local_url is not None:
+                self.record('revalidated', url, 304, 0, response.elapsed.total_seconds(), time.perf_counter() - start)
+                return local_url
+            # 304 but the entry was evicted in the meantime.
+            start = time.perf_counter()
+            response = _request(url, session, {}, rate_limiter)
+        with response:
+            if response.status_code != 200:
+                self.record('miss', url, response.status_code, 0, response.elapsed.total_seconds(),
+                            time.perf_counter() - start)
+                logger.error(response)
+                raise ConnectionError()
+            local_url = self.put(url, response.iter_content(chunk_size=64 * 1024), response.headers)
+            self.record('miss', url, 200, os.path.getsize(local_url), response.elapsed.total_seconds(),
+                        time.perf_counter() - start)
+            return local_url
+
+    def record(self, result: str, url: Union[None, str] = None, status: int = 0, num_bytes: int = 0,
+               ttfb: float = 0.0, duration: float = 0.0):
+        """
+        Record a cache lookup, and the request if there was one, in the metrics of the cache (if any).
+        :param result: hit, revalidated or miss.
+        :param url: URL of the photo, if it was requested.
+        :param status: HTTP status code of the response.
+        :param num_bytes: Size of the photo downloaded.
+        :param ttfb: Number of seconds until the headers of the response were received.
+        :param duration: Total number of seconds of the request (including the download).
+        """
+        if self.metrics is None:
+            return
+        self.metrics.increment('cache_requests_total', labels={'cache': 'photo', 'result': result})
+        if url is not None:
+            self.metrics.record_request(urlparse(url).netloc, status, num_bytes, ttfb, max(0.0, duration - ttfb))
+
+    def get(self, url: str) -> Union[None, str]:
+        """
+        :param url: URL of the photo.
+        :rtype: Local path to the photo if it is cached and fresh, None otherwise.
+        """
+        path, meta = self._path(url), self._read_meta(url)
+        if meta is None or not path.exists() or time.time() - meta['fetched_at'] > self.max_age:
+            return None
+        self._used(path)
+        return str(path)
+
+    def validators(self, url: str) -> Dict[str, str]:
+        """
+        :param url: URL of the photo.
+        :rtype: Headers for a conditional request on a stale entry (empty if the photo is not cached).
+        """
+        meta = self._read_meta(url)
+        headers = {}
+        if meta is None or not self._path(url).exists():
+            return headers
+        if meta.get('etag') is not None:
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified') is not None:
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def revalidated(self, url: str) -> Union[None, str]:
+        """
+        Mark a stale entry as fresh again (the server answered 304 Not Modified).
+        :param url: URL of the photo.
+        :rtype: Local path to the photo (None if it was evicted in the meantime).
+        """
+        path, meta = self._path(url), self._read_meta(url)
+        if meta is None or not path.exists():
+            return None
+        meta['fetched_at'] = time.time()
+        self._write_meta(url, meta)
+        self._used(path)
+        return str(path)
+
+    def put(self, url: str, content: Union[bytes, Iterable[bytes]], headers: Dict[str, str]) -> str:
+        """
+        Store a photo. The write is atomic: readers never see a partially written file.
+        :param url: URL of the photo.
+        :param content: Body of the response (bytes or chunks of bytes).
+        :param headers: Headers of the response (for ETag and Last-Modified).
+        :rtype: Local path to the photo.
+        """
+        if isinstance(content, bytes):
+            content = [content]
+        path = self._path(url)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as w:
+                for chunk in content:
+                    w.write(chunk)
+            new_size = os.path.getsize(tmp_path)
+            self._write_meta(url, {
+                'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'fetched_at': time.time()
+            })
+            with self._lock:
+                os.replace(tmp_path, str(path))
+                self._size += new_size - self._entries.pop(str(path), 0)
+                self._entries[str(path)] = new_size
+                self._evict(keep=str(path))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return str(path)
+
+    def _used(self, path: Path):
+        self._touch(path)
+        with self._lock:
+            if str(path) in self._entries:
+                self._entries.move_to_end(str(path))
+
+    def _evict(self, keep: str):
+        # least recently used first.
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            if path == keep:
+                self._entries[path] = size
+                continue
+            self._size -= size
+            for p in (Path(path), Path(path).with_suffix('.json')):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            logger.debug(f'Evicted {path} from the photo cache.')
+
+    def _photo_files(self):
+        return [p for p in self.directory.iterdir() if p.suffix not in ('.json', '.tmp')]
+
+    def _path(self, url: str) -> Path:
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()[:32]
+        ext = Path(urlparse(url).path).suffix or '.jpg'
+        return self.directory / (key + ext)
+
+    def _read_meta(self, url: str) -> Union[None, dict]:
+        meta_path = self._path(url).with_suffix('.json')
+        try:
+            with open(str(meta_path), 'r') as r:
+                return json.load(r)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, url: str, meta: dict):
+        meta_path = self._path(url).with_suffix('.json')
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        with os.fdopen(fd, 'w') as w:
+            json.dump(meta, w)
+        os.replace(tmp_path, str(meta_path))
+
+    @staticmethod
+    def _touch(path: Path):
+        try:
+            os.utime(str(path))
+        except OSError:
+            pass
+
+
+def _request(url: str,
+             session: Union[None, requests.Session],
+             headers: Dict[str, str],
+             rate_limiter: Union[None, RateLimiter]) -> requests.Response:
+    if rate_limiter is not None:
+        rate_limiter.acquire(url)
+    if session is None:
+        return requests.get(url, headers={**DEFAULT_HEADERS, **headers}, timeout=DEFAULT_TIMEOUT, stream=True)
+    return session.get(url, headers=headers, timeout=DEFAULT_TIMEOUT, stream=True)
+
+
+_default_photo_cache = None
+
+
+def default_photo_cache() -> PhotoCache:
+    """
+    :rtype: The photo cache shared by the backends that were not given their own.
+    """
+    global _default_photo_cache
+    if _default_photo_cache is None:
+        _default_photo_cache = PhotoCache()
+    return _default_photo_cache
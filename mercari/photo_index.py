@@ -0,0 +1,139 @@
+import logging
+import threading
+from typing import Union, List, Tuple, IO
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Maximum Hamming distance between the hashes of two photos of the same listing (out of 64 bits).
+DEFAULT_MAX_DISTANCE = 4
+
+# Number of bits set in each byte, for the versions of numpy without bitwise_count().
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hash_photo(photo: Union[str, IO[bytes]]) -> int:
+    """
+    Difference hash (dHash) of a photo: the photo is reduced to 9x8 gray pixels and each bit tells if a pixel is
+    brighter than its right neighbour. Robust to resizing and recompression, so a thumbnail and the full size photo
+    have (almost) the same hash. Requires numpy and Pillow.
+    :param photo: Path (or opened binary file) of the photo, e.g. Item.local_url.
+    :rtype: 64-bit hash (Integer).
+    """
+    with Image.open(photo) as image:
+        # JPEG photos are decoded directly at a reduced scale, much faster than a full decode.
+        image.draft('L', (64, 64))
+        pixels = np.asarray(image.convert('L').resize((9, 8), Image.BOX), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distance(hash_1: int, hash_2: int) -> int:
+    """
+    :rtype: Number of bits that differ between two photo hashes.
+    """
+    return bin(hash_1 ^ hash_2).count('1')
+
+
+class PhotoIndex:
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, capacity: int = 1024):
+        """
+        In-memory index of photo hashes (see hash_photo()), searched by Hamming distance. The hashes are stored in a
+        numpy array and compared all at once: a search over a million photos takes a few milliseconds.
+        Thread-safe. Requires numpy and Pillow.
+        :param max_distance: Maximum Hamming distance between two hashes of the same photo.
+        :param capacity: Initial number of hashes (the array grows as needed).
+        """
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(max(capacity, 1), dtype=np.uint64)
+        self._keys: List[str] = []
+        self._positions = {}
+
+    def add(self, key: str, photo_hash: int):
+        """
+        :param key: Identifies the photo, e.g. mercari:m53585037017. Use the same format for all the marketplaces.
+        :param photo_hash: Hash of the photo returned by hash_photo(). Replaces the hash of the same key (if any).
+        """
+        with self._lock:
+            self._add(key, photo_hash)
+
+    def search(self, photo_hash: int, max_distance: Union[None, int] = None) -> List[Tuple[str, int]]:
+        """
+        :param photo_hash: Hash of the photo returned by hash_photo().
+        :param max_distance: Maximum Hamming distance (optional). Defaults to the one of the index.
+        :rtype: Keys of the similar photos and their distance, closest first.
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            distances = self._distances(photo_hash)
+            positions = np.flatnonzero(distances <= max_distance)
+            positions = positions[np.argsort(distances[positions], kind='stable')]
+            return [(self._keys[p], int(distances[p])) for p in positions]
+
+    def seen(self, key: str, photo_hash: int) -> Union[None, str]:
+        """
+        Check if a similar photo was indexed under another key, then index this one.
+        :param key: Identifies the photo, e.g. rakuma:9093de55f88bc28d47c35fd1d4dd23f0.
+        :param photo_hash: Hash of the photo returned by hash_photo().
+        :rtype: Key of the closest similar photo, or None if the photo is new.
+        """
+        with self._lock:
+            distances = self._distances(photo_hash)
+            position = self._positions.get(key)
+            if position is not None:
+                distances[position] = 64 + 1  # never matches itself.
+            match = None
+            if len(distances) > 0:
+                closest = int(np.argmin(distances))
+                if distances[closest] <= self.max_distance:
+                    match = self._keys[closest]
+            self._add(key, photo_hash)
+            return match
+
+    def save(self, path: str):
+        """
+        :param path: Where to write the index (numpy .npz file).
+        """
+        with self._lock:
+            np.savez(path, hashes=self._hashes[:len(self._keys)], keys=np.array(self._keys, dtype=str))
+
+    @classmethod
+    def load(cls, path: str, max_distance: int = DEFAULT_MAX_DISTANCE) -> 'PhotoIndex':
+        """
+        :param path: File written by save().
+        :param max_distance: Maximum Hamming distance between two hashes of the same photo.
+        :rtype: The index.
+        """
+        with np.load(path) as data:
+            hashes, keys = data['hashes'], data['keys'].tolist()
+        index = cls(max_distance, capacity=max(len(keys), 1024))
+        index._hashes[:len(keys)] = hashes
+        index._keys = keys
+        index._positions = {key: position for position, key in enumerate(keys)}
+        return index
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def _add(self, key: str, photo_hash: int):
+        position = self._positions.get(key)
+        if position is None:
+            position = len(self._keys)
+            if position == len(self._hashes):
+                self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), dtype=np.uint64)])
+            self._keys.append(key)
+            self._positions[key] = position
+        self._hashes[position] = photo_hash
+
+    def _distances(self, photo_hash: int) -> np.ndarray:
+        diff = self._hashes[:len(self._keys)] ^ np.uint64(photo_hash)
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(diff).astype(np.int64)
+        return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
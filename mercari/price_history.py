@@ -0,0 +1,273 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, Union, Dict, Iterable
+from urllib.parse import urlparse
+
+import numpy as np
+
+from mercari.common import Item, Listing
+
+logger = logging.getLogger(__name__)
+
+# One row per snapshot. The item is an index in the dictionary of the store (marketplace, item ID and keyword).
+SNAPSHOT_DTYPE = np.dtype([('item', '<u4'), ('timestamp', '<f8'), ('price', '<i4'), ('sold_out', '?')])
+
+
+class PriceHistory:
+
+    def __init__(self, directory: str, segment_size: int = 100000, max_segments: int = 16):
+        """
+        Append-only store of (marketplace, item ID, timestamp, price, sold out) snapshots, in columnar numpy
+        segments that are memory-mapped when read. The queries are vectorized over all the snapshots: no database
+        server needed. Thread-safe, but only one process should write to the same directory. Requires numpy.
+        :param directory: Where to store the segments (created if needed).
+        :param segment_size: Number of snapshots buffered in memory before they are written as a new segment.
+        :param max_segments: The segments are compacted into one when there are more than that (see compact()).
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._buffer: List[tuple] = []
+        # dictionary of the items, appended to items.tsv: one line per item (marketplace, item ID, keyword).
+        self._dictionary_path = self.directory / 'items.tsv'
+        self._items: List[tuple] = []
+        self._codes: Dict[tuple, int] = {}
+        self._num_saved_items = 0
+        if self._dictionary_path.exists():
+            with open(str(self._dictionary_path), 'r', encoding='utf8') as r:
+                for line in r:
+                    marketplace, item_id, keyword = line.rstrip('\n').split('\t')
+                    self._codes[(marketplace, item_id)] = len(self._items)
+                    self._items.append((marketplace, item_id, keyword))
+            self._num_saved_items = len(self._items)
+        self._segments = [np.load(str(p), mmap_mode='r') for p in self._segment_files()]
+
+    def add(self,
+            marketplace: str,
+            item_id: str,
+            price: int,
+            sold_out: bool,
+            timestamp: Union[None, float] = None,
+            keyword: str = ''):
+        """
+        :param marketplace: Name of the backend, e.g. mercari.
+        :param item_id: ID of the item on its marketplace, e.g. m53585037017.
+        :param price: Price in yen.
+        :param sold_out: If the item was sold.
+        :param timestamp: When the item was seen, in seconds since the epoch (optional). Defaults to now.
+        :param keyword: Keyword the item was found with (optional). Only the first one of each item is kept.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._buffer.append((self._code(marketplace, item_id, keyword), timestamp, price, sold_out))
+            if len(self._buffer) >= self.segment_size:
+                self._flush()
+
+    def add_items(self,
+                  items: Iterable[Union[Item, Listing]],
+                  timestamp: Union[None, float] = None,
+                  keyword: str = ''):
+        """
+        :param items: Item objects (get_item_info()) or Listing objects (iter_listings()).
+        :param timestamp: When the items were seen (optional). Defaults to now.
+        :param keyword: Keyword the items were found with (optional).
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        for item in items:
+            self.add(item.marketplace, _item_id(item), item.price, item.sold_out, timestamp, keyword)
+
+    def flush(self):
+        """
+        Write the buffered snapshots to a new segment.
+        """
+        with self._lock:
+            self._flush()
+
+    def compact(self, drop_unchanged: bool = True):
+        """
+        Merge all the segments into one, sorted by item and timestamp.
+        :param drop_unchanged: Also drop the snapshots that repeat the previous state of their item (same price
+        and sold out status), except the last one of each item. The results of the queries do not change.
+        """
+        with self._lock:
+            self._flush(compact=False)
+            self._compact(drop_unchanged)
+
+    def snapshots(self) -> np.ndarray:
+        """
+        :rtype: All the snapshots (flushed or not) in a structured array of SNAPSHOT_DTYPE, in no particular order.
+        """
+        with self._lock:
+            buffer = np.array(self._buffer, dtype=SNAPSHOT_DTYPE)
+            return np.concatenate(self._segments + [buffer])
+
+    def latest(self, keyword: Union[None, str] = None) -> np.ndarray:
+        """
+        :param keyword: Only the items found with this keyword (optional).
+        :rtype: Last snapshot of each item: structured array with the marketplace, the item_id, the keyword, the
+        timestamp, the price and the sold out status.
+        """
+        snapshots = self._sorted_snapshots(keyword)
+        return self._decode(snapshots[_last_of_each_item(snapshots['item'])])
+
+    def price_drops(self, min_drop: float, since: float, keyword: Union[None, str] = None) -> np.ndarray:
+        """
+        Items whose price dropped by more than min_drop since a given time, biggest drop first.
+        The reference price is the price at that time (or the first one seen after it, for the newer items).
+        :param min_drop: Minimum drop, as a fraction of the reference price (e.g. 0.2 for -20%).
+        :param since: Timestamp in seconds since the epoch.
+        :param keyword: Only the items found with this keyword (optional).
+        :rtype: Last snapshot of each item (see latest()) with the reference price (price_before) and the drop.
+        """
+        snapshots = self._sorted_snapshots(keyword)
+        items = snapshots['item']
+        last = _last_of_each_item(items)
+        first = _first_of_each_item(items)
+        # last snapshot at or before since of each item (the snapshots are sorted by item and timestamp).
+        before = np.flatnonzero(snapshots['timestamp'] <= since)
+        before = before[_last_of_each_item(items[before])]
+        reference = first.copy()
+        reference[np.searchsorted(items[first], items[before])] = before
+        price_before = snapshots['price'][reference].astype(np.float64)
+        price = snapshots['price'][last].astype(np.float64)
+        drop = np.divide(price_before - price, price_before, out=np.zeros(len(price)), where=price_before > 0)
+        selected = np.flatnonzero(drop > min_drop)
+        selected = selected[np.argsort(-drop[selected], kind='stable')]
+        latest = self._decode(snapshots[last[selected]])
+        result = np.empty(len(selected), dtype=latest.dtype.descr + [('price_before', '<i4'), ('drop', '<f8')])
+        for name in latest.dtype.names:
+            result[name] = latest[name]
+        result['price_before'] = price_before[selected]
+        result['drop'] = drop[selected]
+        return result
+
+    def time_to_sell(self, keyword: Union[None, str] = None) -> Dict[str, np.ndarray]:
+        """
+        Number of seconds between the first time an item was seen for sale and the first time it was seen sold.
+        The items never seen for sale (sold before their first snapshot) and the unsold items are not counted.
+        :param keyword: Only this keyword (optional).
+        :rtype: Array of durations in seconds per keyword. Use numpy.percentile() etc. for the distribution.
+        """
+        snapshots = self._sorted_snapshots(keyword)
+        items = snapshots['item']
+        first = _first_of_each_item(items)
+        on_sale = ~snapshots['sold_out'][first]
+        # first sold snapshot of each item.
+        sold = np.flatnonzero(snapshots['sold_out'])
+        sold = sold[_first_of_each_item(items[sold])]
+        item_position = np.searchsorted(items[first], items[sold])
+        durations = snapshots['timestamp'][sold] - snapshots['timestamp'][first[item_position]]
+        counted = on_sale[item_position]
+        durations, sold_items = durations[counted], items[sold][counted]
+        keywords = np.array([keyword for _, _, keyword in self._items] or [''], dtype=str)[sold_items]
+        return {k: durations[keywords == k] for k in np.unique(keywords).tolist()}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(segment) for segment in self._segments) + len(self._buffer)
+
+    def _code(self, marketplace: str, item_id: str, keyword: str) -> int:
+        key = (marketplace, item_id)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self._items)
+            # tabs and new lines would break items.tsv.
+            self._items.append((marketplace, item_id, ' '.join(keyword.split())))
+        return code
+
+    def _flush(self, compact: bool = True):
+        if len(self._buffer) == 0:
+            return
+        # the items first, so that a segment never refers to an unknown item.
+        if self._num_saved_items < len(self._items):
+            with open(str(self._dictionary_path), 'a', encoding='utf8') as w:
+                w.writelines('\t'.join(item) + '\n' for item in self._items[self._num_saved_items:])
+            self._num_saved_items = len(self._items)
+        self._write_segment(np.array(self._buffer, dtype=SNAPSHOT_DTYPE))
+        self._buffer = []
+        if compact and len(self._segments) > self.max_segments:
+            self._compact(drop_unchanged=True)
+
+    def _compact(self, drop_unchanged: bool):
+        if len(self._segments) == 0 or (len(self._segments) == 1 and not drop_unchanged):
+            return
+        old_files = self._segment_files()
+        snapshots = np.concatenate(self._segments)
+        snapshots = snapshots[np.lexsort((snapshots['timestamp'], snapshots['item']))]
+        if drop_unchanged and len(snapshots) > 0:
+            items, prices, sold_out = snapshots['item'], snapshots['price'], snapshots['sold_out']
+            changed = np.ones(len(snapshots), dtype=bool)
+            changed[1:] = (items[1:] != items[:-1]) | (prices[1:] != prices[:-1]) | (sold_out[1:] != sold_out[:-1])
+            changed[_last_of_each_item(items)] = True
+            snapshots = snapshots[changed]
+        self._segments = []
+        self._write_segment(snapshots)
+        for p in old_files:
+            p.unlink()
+        logger.debug(f'{len(old_files)} segments compacted into one of {len(snapshots)} snapshots.')
+
+    def _write_segment(self, snapshots: np.ndarray):
+        files = self._segment_files()
+        number = int(files[-1].stem.split('-')[-1]) + 1 if files else 0
+        path = self.directory / f'segment-{number:08d}.npy'
+        # atomic: the readers never see a partially written segment.
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as w:
+            np.save(w, snapshots)
+        os.replace(tmp_path, str(path))
+        self._segments.append(np.load(str(path), mmap_mode='r'))
+
+    def _segment_files(self) -> List[Path]:
+        return sorted(self.directory.glob('segment-*.npy'))
+
+    def _sorted_snapshots(self, keyword: Union[None, str]) -> np.ndarray:
+        snapshots = self.snapshots()
+        if keyword is not None:
+            with self._lock:
+                codes = [code for code, (_, _, k) in enumerate(self._items) if k == keyword]
+            snapshots = snapshots[np.isin(snapshots['item'], codes)]
+        return snapshots[np.lexsort((snapshots['timestamp'], snapshots['item']))]
+
+    def _decode(self, snapshots: np.ndarray) -> np.ndarray:
+        # replaces the item codes by the marketplaces, the item IDs and the keywords.
+        with self._lock:
+            items = [self._items[code] for code in snapshots['item'].tolist()]
+        marketplaces, item_ids, keywords = zip(*items) if items else ((), (), ())
+        dtype = [('marketplace', 'U16'),
+                 ('item_id', f'U{max(map(len, item_ids), default=1)}'),
+                 ('keyword', f'U{max(map(len, keywords), default=1)}'),
+                 ('timestamp', '<f8'), ('price', '<i4'), ('sold_out', '?')]
+        result = np.empty(len(snapshots), dtype=dtype)
+        result['marketplace'] = marketplaces
+        result['item_id'] = item_ids
+        result['keyword'] = keywords
+        for name in ('timestamp', 'price', 'sold_out'):
+            result[name] = snapshots[name]
+        return result
+
+
+def _item_id(item: Union[Item, Listing]) -> str:
+    # see Common.item_id().
+    if isinstance(item, Listing):
+        return item.item_id
+    return urlparse(item.url).path.rstrip('/').split('/')[-1]
+
+
+def _first_of_each_item(items: np.ndarray) -> np.ndarray:
+    # indexes of the first row of each item (the rows are sorted by item).
+    if len(items) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([[True], items[1:] != items[:-1]]))
+
+
+def _last_of_each_item(items: np.ndarray) -> np.ndarray:
+    # indexes of the last row of each item (the rows are sorted by item).
+    if len(items) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([items[1:] != items[:-1], [True]]))
@@ -1,54 +1,70 @@
 import logging
-from time import sleep
 from typing import Union, List, Any
 from urllib.parse import urlencode
 
-from mercari.common import Common, Item, _get_soup
+from lxml import html
+
+# noinspection PyProtectedMember
+from mercari.common import Common, Item, Listing, _has_class
+from mercari.common import SORT_RELEVANCE, SORT_NEWEST, SORT_PRICE_ASC, SORT_PRICE_DESC
 
 logger = logging.getLogger(__name__)
 
+# Values of the sort and order parameters.
+SORT_ORDERS = {
+    SORT_RELEVANCE: ('relevance', 'desc'),
+    SORT_NEWEST: ('created_at', 'desc'),
+    SORT_PRICE_ASC: ('sell_price', 'asc'),
+    SORT_PRICE_DESC: ('sell_price', 'desc')
+}
+
 
 # noinspection SpellCheckingInspection
 class Rakuma(Common):
 
+    first_page_id = 1  # rakuma starts at page 1.
+
     def fetch_all_items(
             self,
             keyword: str = 'bicycle',
             price_min: Union[None, int] = None,
             price_max: Union[None, int] = None,
-            max_items_to_fetch: Union[None, int] = 100
+            max_items_to_fetch: Union[None, int] = 100,
+            prefetch: int = 1,
+            sort: str = SORT_RELEVANCE
     ) -> List[str]:
-        items_list = []
-        for page_id in range(1, int(1e9)):  # rakuma starts at page 1.
-            items, _ = self.fetch_items_pagination(keyword, page_id, price_min, price_max)
-            items_list.extend(items)
-            logger.debug(f'Found {len(items_list)} items so far.')
-            if max_items_to_fetch is not None and len(items_list) > max_items_to_fetch:
-                logger.debug(f'Reached the maximum items to fetch: {max_items_to_fetch}.')
-                break
-            sleep(2)
-        logger.debug('No more items to fetch.')
-        return items_list
-
-    def fetch_items_pagination(
-            self,
-            keyword: str,
-            page_id: int = 1,
-            price_min: Union[None, int] = None,
-            price_max: Union[None, int] = None
-    ) -> Union[List[str], Any]:
-        soup = _get_soup(self._fetch_url(page_id, keyword, price_min=price_min, price_max=price_max))
-        items = [item.a.attrs['href'] for item in soup.find_all('div', {'class': 'item-box__image-wrapper'})]
+        # keeps the default keyword of the previous versions.
+        return super().fetch_all_items(keyword, price_min, price_max, max_items_to_fetch, prefetch, sort)
+
+    def _parse_items_page(self, tree: html.HtmlElement) -> Union[List[str], Any]:
+        wrappers = tree.xpath(f'//div[{_has_class("item-box__image-wrapper")}]')
+        items = [item.xpath('.//a')[0].get('href') for item in wrappers]
         return items, None
 
-    def get_item_info(
-            self,
-            item_url: str
-    ) -> Item:
-        soup = _get_soup(item_url)
+    def _parse_listings_page(self, tree: html.HtmlElement) -> Union[List[Listing], Any]:
+        listings = []
+        for box in tree.xpath(f'//div[{_has_class("item-box")}]'):
+            # one pass over the elements of the box (see Mercari._parse_listings_page()).
+            url, name, price, sold_out, url_thumbnail = None, '', '0', False, None
+            for element in box.iter('a', 'img', 'p', 'span', 'div'):
+                classes = (element.get('class') or '').split()
+                if element.tag == 'a' and url is None:
+                    url = element.get('href')
+                elif element.tag == 'img' and url_thumbnail is None:
+                    url_thumbnail = element.get('data-original')
+                elif 'item-box__item-name' in classes:
+                    name = ''.join(element.xpath('.//span/text()'))
+                elif element.tag == 'span' and element.get('data-content') not in (None, 'JPY'):
+                    price = element.get('data-content')
+                elif 'item-box__soldout_ribbon' in classes:
+                    sold_out = True
+            listings.append(Listing(item_id=self.item_id(url), url=url, name=name, price=price, sold_out=sold_out,
+                                    url_thumbnail=url_thumbnail, marketplace=self.name))
+        return listings, None
 
+    def _parse_item_page(self, tree: html.HtmlElement, item_url: str) -> Item:
         def fetch_meta(n):
-            return soup.find('meta', {'property': n}).attrs['content']
+            return str(tree.xpath('//meta[@property=$n]/@content', n=n)[0])
 
         name = fetch_meta('og:title')
         if '|' in name:
@@ -60,6 +76,9 @@ class Rakuma(Common):
             sold_out='out' in fetch_meta('product:availability'),
             url_photo=fetch_meta('og:image'),
             url=item_url,
+            session=self._session,
+            photo_cache=self.photo_cache,
+            marketplace=self.name
         )
 
         return item
@@ -69,10 +88,12 @@ class Rakuma(Common):
             page: int = 0,
             keyword: str = 'bicycle',
             price_min: Union[None, int] = None,
-            price_max: Union[None, int] = None
+            price_max: Union[None, int] = None,
+            sort: str = SORT_RELEVANCE
     ) -> str:
         # https://fril.jp/s?max=30000&min=10000&order=desc&page=2&query=clothes&sort=relevance
-        params = {'query': keyword, 'order': 'desc', 'sort': 'relevance'}
+        sort, order = SORT_ORDERS[sort]
+        params = {'query': keyword, 'order': order, 'sort': sort}
         if price_min is not None:
             params.update({'min': price_min})
         if price_max is not None:
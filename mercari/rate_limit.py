@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Union
+from urllib.parse import urlparse
+
+# Hosts of the pages of each marketplace: they share one bucket in RateLimiter (the search pages and the item pages
+# of Rakuma are on two hosts). The photos are on other hosts.
+MARKETPLACE_HOSTS = {'www.mercari.com': 'mercari', 'fril.jp': 'rakuma', 'item.fril.jp': 'rakuma'}
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Thread-safe token bucket.
+        :param rate: Number of tokens added per second (i.e. the sustained request rate).
+        :param burst: Maximum number of tokens that can be accumulated (i.e. the maximum burst of requests).
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available.
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        Wait (without blocking the event loop) until a token is available.
+        """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _reserve(self) -> float:
+        # takes a token, possibly in advance. Returns the number of seconds to wait before using it.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float, burst: int = 1, hosts: Union[None, Dict[str, str]] = None):
+        """
+        One token bucket per marketplace, and per host for the other hosts (e.g. the photos).
+        :param rate: Maximum number of requests per second to the same marketplace (or host).
+        :param burst: Maximum burst of requests to the same marketplace (or host).
+        :param hosts: Name of the bucket of each host (optional). Defaults to MARKETPLACE_HOSTS.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.hosts = MARKETPLACE_HOSTS if hosts is None else hosts
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        """
+        :param url: URL (or host) of the request.
+        :rtype: The token bucket of the marketplace (or of the host).
+        """
+        key = self.key(url)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    def key(self, url: str) -> str:
+        """
+        :param url: URL (or host) of the request.
+        :rtype: Name of its bucket: the marketplace of the host (see hosts), or the host itself.
+        """
+        host = urlparse(url).netloc or url
+        return self.hosts.get(host, host)
+
+    def acquire(self, url: str):
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url: str):
+        await self.bucket(url).acquire_async()
@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Union
+
+from mercari.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PollJob:
+
+    def __init__(self, name: str, poll: Callable[[], int], interval: float):
+        """
+        :param name: Name of the job (for the logs).
+        :param poll: Function called at every poll. Returns the number of new items found.
+        :param interval: Initial number of seconds between two polls.
+        """
+        self.name = name
+        self.poll = poll
+        self.interval = interval
+        self.next_time = 0.0
+        self.num_polls = 0
+        self.num_new_items = 0
+
+
+class PollScheduler:
+
+    def __init__(self,
+                 max_workers: int = 4,
+                 min_interval: float = 10,
+                 max_interval: float = 600,
+                 speed_up: float = 0.5,
+                 slow_down: float = 1.2,
+                 metrics: Union[None, Metrics] = None):
+        """
+        Run many polling jobs from a small pool of worker threads.
+        The interval of each job adapts to how often it finds new items: it is multiplied by speed_up when
+        the last poll found new items and by slow_down otherwise, within [min_interval, max_interval].
+        Combine it with a RateLimiter shared by the backends to enforce a global request budget per marketplace.
+        :param max_workers: Maximum number of jobs running at the same time.
+        :param min_interval: Minimum number of seconds between two polls of the same job.
+        :param max_interval: Maximum number of seconds between two polls of the same job.
+        :param speed_up: Factor applied to the interval when new items were found.
+        :param slow_down: Factor applied to the interval when nothing new was found (or the poll failed).
+        :param metrics: Where to record the duration of the polls and how late they start (optional).
+        A growing poll_lag_seconds means that the workers cannot keep up with the jobs.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.speed_up = speed_up
+        self.slow_down = slow_down
+        self.metrics = metrics
+        self.jobs: List[PollJob] = []
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stopped = False
+
+    def add(self, name: str, poll: Callable[[], int], interval: float, delay: float = 0) -> PollJob:
+        """
+        :param name: Name of the job (for the logs).
+        :param poll: Function called at every poll. Returns the number of new items found.
+        :param interval: Initial number of seconds between two polls.
+        :param delay: Number of seconds before the first poll.
+        :rtype: The job.
+        """
+        job = PollJob(name, poll, interval)
+        self.jobs.append(job)
+        self._schedule(job, time.monotonic() + delay)
+        return job
+
+    def add_spread(self, jobs: List[tuple], interval: float) -> List[PollJob]:
+        """
+        Add many jobs whose first polls are spread evenly over one interval (instead of all at once).
+        :param jobs: List of (name, poll).
+        :param interval: Initial number of seconds between two polls.
+        :rtype: The jobs.
+        """
+        return [self.add(name, poll, interval, delay=i * interval / len(jobs)) for i, (name, poll) in enumerate(jobs)]
+
+    def run_forever(self):
+        """
+        Dispatch the jobs when they are due, until stop() is called.
+        """
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cond.wait(timeout=self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._stopped:
+                    break
+                _, _, job = heapq.heappop(self._heap)
+            self._workers.acquire()
+            if self.metrics is not None:
+                self.metrics.observe('poll_lag_seconds', time.monotonic() - job.next_time)
+            self._executor.submit(self._run, job)
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self, job: PollJob):
+        start = time.monotonic()
+        result = 'ok'
+        try:
+            num_new_items = job.poll()
+        except Exception:
+            logger.exception(f'[{job.name}] Poll failed.')
+            num_new_items = 0
+            result = 'error'
+        finally:
+            self._workers.release()
+        if self.metrics is not None:
+            self.metrics.observe('poll_seconds', time.monotonic() - start, {'job': job.name})
+            self.metrics.increment('polls_total', labels={'result': result})
+            self.metrics.increment('new_items_total', num_new_items)
+        job.num_polls += 1
+        job.num_new_items += num_new_items
+        factor = self.speed_up if num_new_items > 0 else self.slow_down
+        job.interval = min(self.max_interval, max(self.min_interval, job.interval * factor))
+        logger.debug(f'[{job.name}] {num_new_items} new items. Next poll in {job.interval:.1f} seconds.')
+        self._schedule(job, time.monotonic() + job.interval)
+
+    def _schedule(self, job: PollJob, next_time: float):
+        with self._cond:
+            job.next_time = next_time
+            heapq.heappush(self._heap, (next_time, next(self._seq), job))
+            self._cond.notify_all()
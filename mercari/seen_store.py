@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import Union, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.01):
+        """
+        :param capacity: Expected number of elements.
+        :param error_rate: Probability of a false positive when the filter holds capacity elements.
+        """
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: str):
+        for i in self._indexes(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def _indexes(self, key: str):
+        # double hashing: h1 + i * h2.
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+class SeenStore:
+
+    def __init__(self,
+                 filename: str = ':memory:',
+                 max_age: Union[None, float] = None,
+                 bloom_capacity: Union[None, int] = 1000000):
+        """
+        Persistent set of the items already seen, keyed by (marketplace, item id). Safe to share between threads.
+        :param filename: Path to the SQLite database (created if it does not exist).
+        :param max_age: Number of seconds after which an item is forgotten (optional). None means never.
+        :param bloom_capacity: Size of the Bloom filter in front of the database (None to disable it).
+        Items that were never seen are answered from memory, without querying the database.
+        """
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS seen (marketplace TEXT, item_id TEXT, seen_at REAL, '
+                           'PRIMARY KEY (marketplace, item_id)) WITHOUT ROWID')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS seen_at_index ON seen (seen_at)')
+        self._bloom = None
+        if bloom_capacity is not None:
+            self._bloom = BloomFilter(bloom_capacity)
+            for marketplace, item_id in self._conn.execute('SELECT marketplace, item_id FROM seen'):
+                self._bloom.add(_key(marketplace, item_id))
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return self.contains(*key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def contains(self, marketplace: str, item_id: str) -> bool:
+        """
+        :param marketplace: Name of the backend (e.g. mercari).
+        :param item_id: ID of the item (see Common.item_id()).
+        :rtype: True if the item was seen (and not forgotten).
+        """
+        with self._lock:
+            return self._contains(marketplace, item_id)
+
+    def add(self, marketplace: str, item_id: str) -> bool:
+        """
+        :param marketplace: Name of the backend (e.g. mercari).
+        :param item_id: ID of the item (see Common.item_id()).
+        :rtype: True if the item was not seen before.
+        """
+        return self.add_many(marketplace, [item_id]) == [item_id]
+
+    def add_many(self, marketplace: str, item_ids: List[str]) -> List[str]:
+        """
+        :param marketplace: Name of the backend (e.g. mercari).
+        :param item_ids: IDs of the items.
+        :rtype: The IDs that were not seen before, in the same order.
+        """
+        now = time.time()
+        with self._lock:
+            new_item_ids = []
+            for item_id in item_ids:
+                if item_id not in new_item_ids and not self._contains(marketplace, item_id):
+                    new_item_ids.append(item_id)
+            self._conn.executemany('INSERT OR REPLACE INTO seen VALUES (?, ?, ?)',
+                                   [(marketplace, item_id, now) for item_id in new_item_ids])
+            if self._bloom is not None:
+                for item_id in new_item_ids:
+                    self._bloom.add(_key(marketplace, item_id))
+        return new_item_ids
+
+    def discard(self, marketplace: str, item_ids: List[str]):
+        """
+        Forget items, e.g. items that could not be processed and must be found again by the next poll.
+        :param marketplace: Name of the backend (e.g. mercari).
+        :param item_ids: IDs of the items.
+        """
+        # the bloom filter is only a pre-check: the database decides.
+        with self._lock:
+            self._conn.executemany('DELETE FROM seen WHERE marketplace = ? AND item_id = ?',
+                                   [(marketplace, item_id) for item_id in item_ids])
+
+    def expire(self) -> int:
+        """
+        Delete the items older than max_age from the database.
+        :rtype: Number of deleted items.
+        """
+        if self.max_age is None:
+            return 0
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM seen WHERE seen_at < ?', (time.time() - self.max_age,))
+        logger.debug(f'{cursor.rowcount} items expired.')
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _contains(self, marketplace: str, item_id: str) -> bool:
+        if self._bloom is not None and _key(marketplace, item_id) not in self._bloom:
+            return False
+        row = self._conn.execute('SELECT seen_at FROM seen WHERE marketplace = ? AND item_id = ?',
+                                 (marketplace, item_id)).fetchone()
+        if row is None:
+            return False
+        return self.max_age is None or row[0] >= time.time() - self.max_age
+
+
+def _key(marketplace: str, item_id: str) -> str:
+    return f'{marketplace}/{item_id}'
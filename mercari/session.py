@@ -0,0 +1,52 @@
+import logging
+from typing import Union
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {'User-Agent': "'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 "
+                                 "(KHTML, like Gecko) Chrome/29.0.1547.62 Safari/537.36'"}
+
+DEFAULT_TIMEOUT = 20
+
+# Status codes of the responses that are retried.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def build_session(
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        transport: Union[None, BaseAdapter] = None
+) -> requests.Session:
+    """
+    Build a pooled HTTP session. Connections are kept alive and re-used between requests.
+    :param pool_connections: Number of hosts to keep a connection pool for.
+    :param pool_maxsize: Maximum number of connections kept open per host.
+    :param max_retries: Number of retries on connection errors and 429/5xx responses.
+    :param backoff_factor: Exponential backoff factor between two retries (in seconds).
+    :param transport: Custom adapter mounted for http:// and https:// (e.g. to talk to a local fake server).
+    :rtype: requests.Session.
+    """
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    if transport is None:
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False
+        )
+        transport = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retries,
+            pool_block=True
+        )
+    session.mount('http://', transport)
+    session.mount('https://', transport)
+    return session
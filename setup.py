@@ -9,8 +9,12 @@ setup(
     install_requires=[
         'mailthon',
         'requests',
-        'beautifulsoup4',
-        'lxml',
-        'wget'
-    ]
+        'lxml'
+    ],
+    extras_require={
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+        'arrow': ['pyarrow'],
+        'photos': ['numpy', 'Pillow']
+    }
 )
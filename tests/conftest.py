@@ -0,0 +1,13 @@
+import collections
+import collections.abc
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# the benchmarks and the examples are scripts, not packages.
+sys.path[:0] = [str(ROOT), str(ROOT / 'benchmarks'), str(ROOT / 'examples')]
+
+# mailthon (examples/notifications.py) still imports MutableMapping from collections, removed in Python 3.10.
+if not hasattr(collections, 'MutableMapping'):
+    collections.MutableMapping = collections.abc.MutableMapping
@@ -0,0 +1,77 @@
+import email
+import json
+import socket
+
+import pytest
+
+from mercari import Item, PhotoCache
+
+pytest.importorskip('mailthon')
+controller = pytest.importorskip('aiosmtpd.controller')
+
+from notifications import Alertzy, GMailSender, NotificationDispatcher  # noqa: E402
+
+PHOTO = b'\xff\xd8\xff\xe0 photo'
+
+
+class Handler:
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(email.message_from_bytes(envelope.content))
+        return '250 OK'
+
+
+@pytest.fixture
+def smtp(tmp_path, monkeypatch):
+    handler = Handler()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = controller.Controller(handler, hostname='127.0.0.1', port=port)
+    server.start()
+    monkeypatch.chdir(tmp_path)
+    with open('gmail_conf.json', 'w') as w:
+        json.dump({'gmail_user': 'monitor@example.com', 'gmail_password': '', 'recipients': 'me@example.com',
+                   'smtp_host': '127.0.0.1', 'smtp_port': port}, w)
+    yield handler
+    server.stop()
+
+
+def _item(tmp_path, name: str, photo: bool) -> Item:
+    item = Item(name=name, price=1000, desc='', sold_out=False, url_photo='http://127.0.0.1:1/photo.jpg',
+                url=f'https://www.mercari.com/jp/items/{name}/', photo_cache=PhotoCache(str(tmp_path / 'photos')))
+    if photo:
+        path = tmp_path / f'{name}.jpg'
+        path.write_bytes(PHOTO)
+        item.local_url = str(path)
+    return item
+
+
+def test_dispatcher_sends_digest(smtp, tmp_path):
+    dispatcher = NotificationDispatcher(GMailSender(), None, digest_window=0.5, backoff=0)
+    dispatcher.start()
+    # the photo of the second item cannot be downloaded: the email is sent without it.
+    dispatcher.submit('chanel', _item(tmp_path, 'm1', photo=True))
+    dispatcher.submit('chanel', _item(tmp_path, 'm2', photo=False))
+    dispatcher.stop(timeout=30)
+
+    assert [m['Subject'] for m in smtp.messages] == ['Mercari', '2 new items for chanel']
+    parts = [part for part in smtp.messages[1].walk() if part.get_filename() is not None]
+    assert [part.get_payload(decode=True) for part in parts] == [PHOTO]
+    assert dispatcher.stats()['sent_items'] == 2
+    assert dispatcher.stats()['retries'] == 0
+
+
+def test_dispatcher_skips_unconfigured_channels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dispatcher = NotificationDispatcher(GMailSender(), Alertzy(), digest_window=0, backoff=0)
+    dispatcher.start()
+    dispatcher.submit('chanel', _item(tmp_path, 'm1', photo=True))
+    dispatcher.stop(timeout=30)
+
+    assert dispatcher.stats()['submitted'] == 1
+    assert dispatcher.stats()['sent_notifications'] == 0
+    assert dispatcher.stats()['sent_items'] == 0
@@ -0,0 +1,42 @@
+import pytest
+
+from mercari import Mercari, Rakuma
+# noinspection PyProtectedMember
+from mercari.common import _parse_html
+
+# before the import of the benchmark: beautifulsoup4 is not a dependency of the package.
+pytest.importorskip('bs4')
+
+import parsing  # noqa: E402
+
+CASES = {
+    'mercari_search.html': (parsing.soup_mercari_search, parsing.lxml_search(Mercari())),
+    'mercari_item.html': (parsing.soup_mercari_item, parsing.lxml_item(Mercari())),
+    'rakuma_search.html': (parsing.soup_rakuma_search, parsing.lxml_search(Rakuma())),
+    'rakuma_item.html': (parsing.soup_rakuma_item, parsing.lxml_item(Rakuma())),
+}
+
+
+@pytest.mark.parametrize('fixture', sorted(CASES))
+def test_lxml_same_as_beautifulsoup(fixture):
+    soup_parse, lxml_parse = CASES[fixture]
+    content = (parsing.FIXTURES / fixture).read_bytes()
+    assert lxml_parse(content) == soup_parse(content)
+
+
+@pytest.mark.parametrize('backend', [Mercari(), Rakuma()], ids=lambda backend: backend.name)
+def test_listings_same_as_items(backend):
+    tree = _parse_html((parsing.FIXTURES / f'{backend.name}_search.html').read_bytes())
+    urls, _ = backend._parse_items_page(tree)
+    listings, _ = backend._parse_listings_page(tree)
+    assert [listing.url for listing in listings] == urls
+    assert [listing.item_id for listing in listings] == [backend.item_id(url) for url in urls]
+
+
+def test_comment_in_description():
+    # known difference (see benchmarks/fixtures/README.md): the comments are only kept by BeautifulSoup.
+    content = (parsing.FIXTURES / 'mercari_item.html').read_text(encoding='utf8')
+    content = content.replace('<div class="item-description f14">',
+                              '<div class="item-description f14">line1<!-- c -->line2', 1).encode('utf8')
+    assert parsing.lxml_item(Mercari())(content)[2].startswith('line1line2')
+    assert parsing.soup_mercari_item(content)[2].startswith('line1 c line2')
@@ -0,0 +1,33 @@
+import pytest
+
+import replay_server
+from mercari import Mercari, Rakuma, PhotoCache, build_session
+# noinspection PyProtectedMember
+from mercari.common import _parse_html
+
+BACKENDS = {'mercari': Mercari, 'rakuma': Rakuma}
+
+
+@pytest.fixture(scope='module')
+def port():
+    process, port = replay_server.start()
+    yield port
+    process.terminate()
+    process.join()
+
+
+@pytest.mark.parametrize('backend_name', sorted(BACKENDS))
+def test_fetch_through_transport(backend_name, port, tmp_path):
+    session = build_session(transport=replay_server.RewriteAdapter(port))
+    backend = BACKENDS[backend_name](session=session, photo_cache=PhotoCache(str(tmp_path)))
+    search_page = (replay_server.FIXTURES / f'{backend_name}_search.html').read_bytes()
+    expected_urls, _ = backend._parse_items_page(_parse_html(search_page))
+
+    urls = backend.fetch_items_pagination('CHANEL')[0]
+    assert urls == expected_urls
+
+    item = backend.get_item_info(urls[0])
+    assert item.url == urls[0]
+    assert item.price > 0
+    with open(item.local_url, 'rb') as r:
+        assert r.read() == (replay_server.FIXTURES / 'photo.jpg').read_bytes()